@@ -8,33 +8,362 @@ import time
 import logging
 import tempfile
 import datetime
+import threading
+import re
 import struct
 import os.path
 import zipfile
+import mmap
+import socket
+import random
+import signal
+import resource
+from contextlib import contextmanager
 
 log = np.log
 now = datetime.datetime.now
 ONE_HOUR = datetime.timedelta(hours=1)
 QUARTER_HOUR = datetime.timedelta(minutes=15)
 
+# dense samples every token from all K topics. alias, for topk models,
+# only looks at the document's top topics and draws the rest from a
+# table per (word, feature) pair; the samples come from the same
+# distribution.
+SAMPLERS = ("dense", "alias")
+
+# corpus compilation reads roughly this many bytes of text at a time
+READ_CHUNK_SIZE = 64 * 1024 * 1024
+READ_CHUNK_ROWS = 1024 * 1024
+# how many rows of a J x K matrix we make dense at a time, when sampling
+# top-k rows
+TOPK_BLOCK_ROWS = 4096
+# matches the word of an item that has no feature, e.g. the 12 in "12:1"
+# items with only the first k of their ids, e.g. "word:count" for k = 1
+SHORT_ITEM = r"(^|\s)(\d+(?:,\d+){%d}):"
+
+class modelfile:
+    """
+    Reads the arrays of a saved model (.npz) one at a time, and only when
+    they're asked for. Arrays stored uncompressed are memory-mapped straight
+    out of the archive; compressed ones are streamed out in pieces, so
+    there's never more than one copy of the array in memory.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.zipf = zipfile.ZipFile(filename)
+        self.members = dict((name[:-4], name) for name in self.zipf.namelist() if name.endswith(".npy"))
+
+    def keys(self):
+        return self.members.keys()
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def __getitem__(self, key):
+        info = self.zipf.getinfo(self.members[key])
+        if info.compress_type == zipfile.ZIP_STORED:
+            array = self.mmap_member(info)
+            if array is not None:
+                return array
+        member = self.zipf.open(info)
+        try:
+            return np.lib.format.read_array(member)
+        finally:
+            member.close()
+
+    def rows(self, key):
+        """
+        The array key, e.g. the documents' topics pi, whether it was saved
+        dense or as top-k rows (see topkrows).
+        """
+        if key in self:
+            return self[key]
+        J, K = self[key + "_shape"]
+        return topkrows(self[key + "_indices"], self[key + "_weights"], self[key + "_residual"], K)
+
+    def mmap_member(self, info):
+        with open(self.filename, "rb") as f:
+            # skip over the member's local header to get to the npy data
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype.hasobject or not shape or not np.prod(shape):
+            # these can't (or needn't) be mapped
+            return None
+        return np.memmap(self.filename, dtype=dtype, mode="r", offset=offset,
+                         shape=shape, order=fortran_order and "F" or "C")
+
+    def close(self):
+        self.zipf.close()
+
+
 def safe_pi_read(filename):
-    zipf = zipfile.ZipFile(filename)
-    buf_s = zipf.read("pi.npy")
-    header = buf_s[:80]
-    dims = map(int, header[header.index("(")+1:header.rindex(")")].split(", "))
-    pi = np.fromstring(buf_s[80:]).reshape(dims)
-    del buf_s, header, dims
-    zipf.close()
+    model = modelfile(filename)
+    pi = model.rows("pi")
+    model.close()
     return pi
 
 
+class topkrows:
+    """
+    A J x K matrix of distributions, one per row (e.g. the documents'
+    topics), that only keeps the topk largest weights of each row. indices
+    and weights are J x topk, best first; residual is the mass of the row's
+    other K - topk entries, which share it evenly. Indexing gives dense
+    rows, so readers can use it like the J x K array.
+    """
+    def __init__(self, indices, weights, residual, K):
+        self.indices = indices
+        self.weights = weights
+        self.residual = residual
+        self.K = int(K)
+        self.shape = (len(indices), self.K)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def fill(self, rows=slice(None)):
+        # what each of the other entries of the rows is worth
+        return self.residual[rows] / max(self.K - self.indices.shape[1], 1)
+
+    def __getitem__(self, rows):
+        indices = np.asarray(self.indices[rows])
+        dense = np.empty(indices.shape[:-1] + (self.K,), dtype=self.weights.dtype)
+        dense[:] = np.asarray(self.fill(rows))[..., np.newaxis]
+        if indices.ndim == 1:
+            dense[indices] = self.weights[rows]
+        else:
+            dense[np.arange(len(indices))[:, np.newaxis], indices] = self.weights[rows]
+        return dense
+
+    def copy(self):
+        return topkrows(self.indices.copy(), self.weights.copy(), self.residual.copy(), self.K)
+
+    def logmean(self):
+        """
+        The mean of the (clipped) log of every column, without making the
+        rows dense.
+        """
+        logfill = np.log(clip(self.fill()))
+        total = np.empty(self.K)
+        total[:] = logfill.sum()
+        np.add.at(total, self.indices.ravel(), (np.log(clip(self.weights)) - logfill[:, np.newaxis]).ravel())
+        return total / len(self)
+
+    def arrays(self, key):
+        # how the rows get saved as key, for modelfile.rows
+        return {key + "_indices": self.indices, key + "_weights": self.weights,
+                key + "_residual": self.residual, key + "_shape": np.array(self.shape)}
+
+
+def topk(rows, k):
+    """
+    Keeps the k largest entries of every row of a dense matrix, as topkrows.
+    """
+    K = rows.shape[1]
+    k = min(k, K)
+    indices = np.argpartition(-rows, k - 1, axis=1)[:, :k]
+    weights = rows[np.arange(len(rows))[:, np.newaxis], indices]
+    order = np.argsort(-weights, axis=1, kind='mergesort')
+    indices = indices[np.arange(len(rows))[:, np.newaxis], order]
+    weights = weights[np.arange(len(rows))[:, np.newaxis], order]
+    residual = np.maximum(rows.sum(1) - weights.sum(1), 0)
+    return topkrows(indices.astype(np.int32), weights, residual.astype(rows.dtype), K)
+
+
+def topk_blocks(rows, k, dtype):
+    """
+    topk of a big dense (maybe memory-mapped) matrix, a block of rows at a time.
+    """
+    blocks = [topk(np.asarray(rows[i:i + TOPK_BLOCK_ROWS], dtype=dtype), k)
+              for i in xrange(0, len(rows), TOPK_BLOCK_ROWS)]
+    return topkrows(np.concatenate([b.indices for b in blocks]), np.concatenate([b.weights for b in blocks]),
+                    np.concatenate([b.residual for b in blocks]), rows.shape[1])
+
+
+class checkpointer:
+    """
+    Writes model snapshots from a background thread, so training doesn't
+    stall while a big model goes to disk. Only one write is in flight at a
+    time; saving again first waits for the previous one.
+
+    A background checkpoint that fails only logs the error, and training
+    goes on. Any other save raises it, from save itself.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, filename, finish=None, background=True, **arrays):
+        """
+        Copies arrays and writes them uncompressed to filename in the
+        background, then calls finish (e.g. to rename the file into place).
+        Unless background, waits for the write to finish.
+        """
+        self.wait()
+        snapshot = dict((key, np.array(value, copy=True)) for key, value in arrays.iteritems())
+
+        def write():
+            try:
+                np.savez(filename, **snapshot)
+                if finish:
+                    finish()
+            except Exception:
+                if background:
+                    logging.exception("Failed to write checkpoint %s." % filename)
+                else:
+                    self.error = sys.exc_info()
+
+        self.thread = threading.Thread(target=write, name="checkpointer")
+        self.thread.start()
+        if not background:
+            self.wait()
+
+    def wait(self):
+        """
+        Waits for the write in flight, and raises its error if it was a
+        save that wasn't in the background.
+        """
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+
+class phasetimer:
+    """
+    Wall clock and CPU seconds spent in each phase of an iteration, to see
+    where the time goes. Run a phase under
+
+        with timer("estep"):
+            ...
+
+    (phases may nest, e.g. a scatter inside the E step), and call lap()
+    at the end of the iteration to close its row. CPU time counts all of
+    our threads, so it's more than the wall time when xmod runs in
+    parallel. lap() also records our peak resident memory so far, in MB.
+    """
+    def __init__(self, phases):
+        self.phases = list(phases)
+        self.wall = []
+        self.cpu = []
+        self.maxrss = []
+        self.reset()
+
+    def reset(self):
+        self.current_wall = np.zeros(len(self.phases))
+        self.current_cpu = np.zeros(len(self.phases))
+
+    @contextmanager
+    def __call__(self, phase):
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - wall, time.clock() - cpu)
+
+    def add(self, phase, wall, cpu):
+        i = self.phases.index(phase)
+        self.current_wall[i] += wall
+        self.current_cpu[i] += cpu
+
+    def lap(self):
+        self.wall.append(self.current_wall)
+        self.cpu.append(self.current_cpu)
+        # ru_maxrss is in kB on Linux
+        self.maxrss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+        self.reset()
+
+    def arrays(self):
+        # how the timings get saved alongside timediffs
+        shape = (len(self.wall), len(self.phases))
+        return dict(phases=np.array(self.phases), phase_wall=np.reshape(self.wall, shape),
+                    phase_cpu=np.reshape(self.cpu, shape), maxrss=np.array(self.maxrss))
+
+    def load(self, model):
+        # older models don't have any timings
+        if 'phase_wall' in model and list(model['phases']) == self.phases:
+            self.wall = list(model['phase_wall'])
+            self.cpu = list(model['phase_cpu'])
+            self.maxrss = list(model['maxrss'])
+
+
+def rng_state():
+    """
+    numpy's and random's generator states, as arrays for a checkpoint.
+    Restore them with set_rng_state.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal, gauss_next = random.getstate()
+    return dict(rng_keys=keys,
+                rng_pos=pos,
+                rng_gauss=np.array([has_gauss, cached_gaussian]),
+                pyrng_version=version,
+                pyrng_state=np.array(internal, dtype=np.int64),
+                pyrng_gauss=np.nan if gauss_next is None else gauss_next)
+
+
+def set_rng_state(model):
+    # older models don't have them
+    if 'rng_keys' in model:
+        has_gauss, cached_gaussian = model['rng_gauss']
+        np.random.set_state(('MT19937', np.asarray(model['rng_keys'], dtype=np.uint32),
+                             int(model['rng_pos']), int(has_gauss), float(cached_gaussian)))
+    if 'pyrng_state' in model:
+        gauss_next = float(model['pyrng_gauss'])
+        if np.isnan(gauss_next):
+            gauss_next = None
+        random.setstate((int(model['pyrng_version']), tuple(int(x) for x in model['pyrng_state']), gauss_next))
+
+
+class stopsignal:
+    """
+    Turns SIGINT and SIGTERM (e.g. a preempted node) into a request to
+    stop, which the trainer checks at the end of each iteration, so the
+    last checkpoint is always a clean one. A second signal stops at once.
+    """
+    def __init__(self):
+        self.requested = False
+        self.previous = {}
+
+    def __enter__(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.previous[signum] = signal.signal(signum, self.request)
+        return self
+
+    def __exit__(self, *exc_info):
+        for signum, handler in self.previous.iteritems():
+            signal.signal(signum, handler)
+        self.previous = {}
+
+    def request(self, signum, frame):
+        if self.requested:
+            raise KeyboardInterrupt
+        logging.info("Caught signal %d. Stopping after this iteration." % signum)
+        self.requested = True
+
+
 class freyr:
-    def __init__(self, data, K=100, model_out=None):
-        self.data=data
-        self.J=self.data[0].max() + 1
-        self.V=self.data[1].max() + 1
-        self.F=self.data[2].max() + 1
-        self.nj=doccounts(data[0])
+    def __init__(self, data, K=100, model_out=None, dtype=np.float64, topk=0):
+        # dtype=np.float32 halves the memory and bandwidth of phi, psi, pi
+        # and their log tables. with topk, pi only keeps each document's
+        # topk best topics (see topkrows), which for large K is most of
+        # the memory.
+        self.dtype = np.dtype(dtype)
+        self.topk = topk
+        self.offsets, self.data = as_csr(data)
+        self.J=len(self.offsets) - 1
+        self.V=self.data[0].max() + 1
+        self.F=self.data[1].max() + 1
+        self.nj=doccounts((self.offsets, self.data))
         self.Nj=int(self.nj.sum())
         self.K=K
 
@@ -42,9 +371,12 @@ class freyr:
         self.beta=np.ones(self.V)/self.V
         self.gamma=np.ones(self.F)/self.F
 
-        self.phi=clip(dirichletrnd(self.beta,self.K))
-        self.psi=clip(dirichletrnd(self.gamma,self.K))
-        self.pi=clip(dirichletrnd(self.theta,self.J))
+        self.phi=clip(dirichletrnd(self.beta,self.K)).astype(self.dtype)
+        self.psi=clip(dirichletrnd(self.gamma,self.K)).astype(self.dtype)
+        if self.topk:
+            self.pi=dirichletrnd_topk(self.theta,(self.J,self.K),self.topk,self.dtype)
+        else:
+            self.pi=clip(dirichletrnd(self.theta,self.J)).astype(self.dtype)
 
         self.phiprior = dirichlet()
         self.phiprior.m = 1.0/self.V
@@ -55,53 +387,133 @@ class freyr:
 
         self.model_out = model_out
 
-        self.burnin = 100
+        # the hyperparameters stay put for the first burnin iterations,
+        # while the samples are still far from the posterior
+        self.burnin = 0
+        # picks xmod's random streams. mcmc draws it unless it's given, and
+        # it's saved with the model so a continued run draws the same ones.
+        self.seed = None
+        self.sampler = "dense"
         self.mcmc_iterations_max = 1000
         self.max_iteration = 0
         self.loglikelihoods = []
         self.timediffs = []
         self.pseudologlikelihood = 0
+        self.checkpointer = checkpointer()
+        self.timer = phasetimer(("sample", "dirichlet", "prior", "save"))
+
+    def mcmc(self, cores=8, chunksize=4096, seed=None, sampler="dense"):
+        if sampler not in SAMPLERS:
+            raise ValueError("Unknown sampler '%s'. Must be one of %s." % (sampler, ", ".join(SAMPLERS)))
+        if sampler == "alias" and not self.topk:
+            raise ValueError("The alias sampler needs a topk model.")
+        self.sampler = sampler
 
-    def mcmc(self, cores=8):
         # need to set up for parallelization
         logging.info("Initializing xmod...")
-        xmod.initialize(cores, self.K)
+        # chunksize is roughly how many token rows a thread grabs at once.
+        # the sampler's random streams come from seed, which by default
+        # comes from numpy's generator so np.random.seed covers both.
+        if seed is not None:
+            self.seed = seed
+        elif self.seed is None:
+            self.seed = np.random.randint(2**31)
+        xmod.initialize(cores, self.K, chunksize, self.seed)
         logging.info("xmod initialized.")
 
         try:
             last_save_time = datetime.datetime.now()
-
-            for iteration in xrange(self.max_iteration + 1, int(self.mcmc_iterations_max) + 1):
-                last_time = now()
-                self.fast_posterior()
-                self.gamma_a_mle()
-                self.theta_a_mle()
-                self.beta_a_mle()
-
-                timediff = datetime.datetime.now() - last_time
-                self.loglikelihoods.append(self.pseudologlikelihood)
-                self.timediffs.append(timediff.total_seconds())
-                self.max_iteration = iteration
-                logging.debug("LL(%4d) = %f, took %s" % (iteration, self.pseudologlikelihood, timediff))
-
-                if now() - last_save_time >= ONE_HOUR and self.model_out:
-                    self.save_model(self.model_out)
-                    logging.debug("%s passed. Saved progress to %s." % (now() - last_save_time, self.model_out))
-                    last_save_time = now()
-
+            stop = stopsignal()
+
+            with stop:
+                for iteration in xrange(self.max_iteration + 1, int(self.mcmc_iterations_max) + 1):
+                    self.iterate(iteration)
+
+                    if now() - last_save_time >= ONE_HOUR and self.model_out:
+                        with self.timer("save"):
+                            self.save_model(self.model_out, background=True)
+                        logging.debug("%s passed. Saving progress to %s in the background." % (now() - last_save_time, self.model_out))
+                        last_save_time = now()
+                    self.timer.lap()
+                    if stop.requested:
+                        logging.info("Stopping at iteration %d." % iteration)
+                        break
 
         except KeyboardInterrupt:
             logging.info("Terminated early. Cleaning up.")
 
+        self.checkpointer.wait()
+
         # have to clean up memory
         logging.debug("Finalizing xmod...")
         xmod.finalize()
         logging.debug("xmod finalized.")
 
+    def iterate(self, iteration):
+        last_time = now()
+        self.fast_posterior()
+        if iteration > self.burnin:
+            with self.timer("prior"):
+                self.gamma_a_mle()
+                self.theta_a_mle()
+                self.beta_a_mle()
+
+        timediff = datetime.datetime.now() - last_time
+        self.loglikelihoods.append(self.pseudologlikelihood)
+        self.timediffs.append(timediff.total_seconds())
+        self.max_iteration = iteration
+        logging.debug("LL(%4d) = %f, took %s" % (iteration, self.pseudologlikelihood, timediff))
+
+    def log_buffers(self):
+        # the log tables are reused from one iteration to the next
+        shapes = (self.phi.shape, (self.psi.shape[0], self.psi.shape[1] + 1),
+                  self.topk and self.pi.weights.shape or self.pi.shape)
+        buffers = getattr(self, "_log_buffers", None)
+        if buffers is None or buffers[0].dtype != self.dtype or \
+                tuple(b.shape for b in buffers) != shapes:
+            buffers = tuple(np.empty(shape, dtype=self.dtype) for shape in shapes)
+            # the first column of logvpsi is the null feature, which is always 1.
+            buffers[1][:,0] = 0
+            self._log_buffers = buffers
+        return buffers
+
+    def doc_slots(self):
+        # where each document's topic counts go in xmod's sparse S: room for
+        # every topic it could hit, which is at most its number of tokens.
+        if getattr(self, "_doc_slots", (None, None))[0] != self.K:
+            tokens = np.concatenate(([0], np.cumsum(self.data[2], dtype=np.int64)))
+            slots = np.minimum(tokens[self.offsets[1:]] - tokens[self.offsets[:-1]], self.K)
+            self._doc_slots = (self.K, np.concatenate(([0], np.cumsum(slots))).astype(np.int64))
+        return self._doc_slots[1]
+
+    def pair_rows(self):
+        # for the alias sampler: the (word, feature) pairs that more than one
+        # row of the corpus has, as a 2 x P array, and which of them each row
+        # has, or -1 if no other row has its pair. the sampler builds a K
+        # entry table for each of them every sweep.
+        if getattr(self, "_pair_rows", None) is None:
+            keys = self.data[0].astype(np.int64) * (self.F + 1) + self.data[1]
+            unique, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+            shared = counts > 1
+            columns = np.cumsum(shared) - 1
+            rows = np.where(shared[inverse], columns[inverse], -1).astype(np.int32)
+            pairs = self.data[:2, first[shared]].astype(np.int32)
+            logging.info("Alias tables for %d (word, feature) pairs take %.1f MB." % (pairs.shape[1], pairs.shape[1] * self.K * 12 / 2.0**20))
+            self._pair_rows = (rows, pairs)
+        return self._pair_rows
+
     def fast_posterior(self):
-        logvpsi=np.hstack(( np.zeros((self.K,1)),log(self.psi)))
-        logphi = log(self.phi)
-        logpi = log(self.pi)
+        logphi, logvpsi, logpi = self.log_buffers()
+        log(self.phi, out=logphi)
+        log(self.psi, out=logvpsi[:,1:])
+        if self.topk:
+            log(self.pi.weights, out=logpi)
+            topk_args = (self.pi.indices, log(clip(self.pi.fill())).astype(np.float64), self.doc_slots())
+            if self.sampler == "alias":
+                topk_args += self.pair_rows()
+        else:
+            log(self.pi, out=logpi)
+            topk_args = ()
 
         if abs(self.pseudologlikelihood) > 1e20 or np.any(np.isnan(logphi)) or np.any(np.isnan(logvpsi)) or np.any(np.isnan(logpi)) or \
                 np.any(logphi > 0) or np.any(logvpsi > 0) or np.any(logpi > 0):
@@ -109,18 +521,35 @@ class freyr:
             import pdb
             pdb.set_trace()
 
-        self.Rphi,self.Rpsi,self.S,Z=xmod.xfactorialposterior(logphi,logvpsi,logpi,self.data,self.Nj,self.V,self.F+1,self.J)
-
-        phi=clip(dirichletrnd_array(self.Rphi+self.beta))
-        psi=clip(dirichletrnd_array(self.Rpsi[:,1:]+self.gamma))
-        vpi=clip(dirichletrnd_array(self.S+self.theta))
-
-        self.phi=row_norm(phi)
-        self.psi=row_norm(psi)
-        self.pi=row_norm(vpi)
+        # the iteration number picks xmod's random streams for this sweep
+        with self.timer("sample"):
+            self.Rphi,self.Rpsi,self.S,Z=xmod.xfactorialposterior(logphi,logvpsi,logpi,self.offsets,self.data,self.V,self.F+1,self.J,self.max_iteration+1,*topk_args)
+        with self.timer("dirichlet"):
+            self.resample()
 
         self.pseudologlikelihood=Z
 
+    def resample(self):
+        # draws phi, psi and pi given the last sweep's counts.
+        # the new samples overwrite the old parameters in place, and the
+        # gamma draws are recycled as the next iteration's scratch space.
+        # top-k documents come back with a sparse S, and are resampled a
+        # block at a time.
+        params = (self.phi, self.psi, self.pi)[:self.topk and 2 or 3]
+        buffers = getattr(self, "_gamma_buffers", (None, None, None))
+        self._gamma_buffers = tuple(
+            dirichletrnd_rows(counts, prior, param, buf)
+            for param, counts, prior, buf in zip(params,
+                                                 (self.Rphi, self.Rpsi[:,1:], self.S),
+                                                 (self.beta, self.gamma, self.theta),
+                                                 buffers))
+        for param in params:
+            clip(param, out=param)
+            row_norm(param, out=param)
+        if self.topk:
+            self.pi = dirichletrnd_topk(self.theta, (self.J, self.K), self.topk, self.dtype,
+                                        (self.doc_slots(),) + self.S)
+
     def beta_a_mle(self):
         self.phiprior.observation(self.phi)
         self.phiprior.a=self.beta.sum()
@@ -130,46 +559,81 @@ class freyr:
             import pdb
             pdb.set_trace()
 
-        self.beta=self.phiprior.a*self.phiprior.m
+        self.beta=self.phiprior.a*self.phiprior.m*np.ones(self.V)
 
     def theta_a_mle(self):
         self.piprior.observation(self.pi)
         self.piprior.a=np.sum(self.theta)
         self.piprior.a_update()
-        self.theta=self.piprior.a*self.piprior.m
+        self.theta=self.piprior.a*self.piprior.m*np.ones(self.K)
 
     def gamma_a_mle(self):
         self.psiprior.observation(self.psi)
         self.psiprior.a = self.gamma.sum()
         self.psiprior.a_update()
-        self.gamma=self.psiprior.a*self.psiprior.m
+        self.gamma=self.psiprior.a*self.psiprior.m*np.ones(self.F)
 
-    def save_model(self, filename):
+    def save_model(self, filename, background=False):
         if np.isnan(self.pseudologlikelihood):
             logging.error("Numerical instability detected. Cowardly refusing to save and dying hard...")
             sys.exit(2)
 
-        np.savez_compressed(
+        def finish():
+            os.rename(filename + ".tmp.npz", filename)
+
+        pi = self.topk and self.pi.arrays("pi") or {"pi": self.pi}
+        self.checkpointer.save(
                 filename + ".tmp.npz",
+                finish,
+                background=background,
                 psi=self.psi,
                 phi=self.phi,
-                pi=self.pi,
                 k=self.K,
                 max_iteration=self.max_iteration,
                 loglikelihoods=self.loglikelihoods,
-                timediffs=self.timediffs)
-
-        os.rename(filename + ".tmp.npz", filename)
+                timediffs=self.timediffs,
+                # what a continued run needs to pick up exactly where we stop
+                beta=self.beta,
+                gamma=self.gamma,
+                theta=self.theta,
+                burnin=self.burnin,
+                seed=self.seed is None and -1 or self.seed,
+                **dict(pi, **dict(self.timer.arrays(), **rng_state())))
 
     def load_model(self, filename):
-        model = np.load(filename)
-        self.psi = model['psi']
-        self.phi = model['phi']
+        model = modelfile(filename)
+        # the parameters are updated in place, so they need to be real
+        # arrays, not maps of the file.
+        self.psi = np.array(model['psi'], dtype=self.dtype)
+        self.phi = np.array(model['phi'], dtype=self.dtype)
         self.K = model['k']
-        self.pi = safe_pi_read(filename) # hack b/c np doesn't buffer things properly
+        pi = model.rows('pi')
+        if self.topk:
+            if isinstance(pi, topkrows) and pi.indices.shape[1] == min(self.topk, self.K):
+                pi = topkrows(np.array(pi.indices), np.array(pi.weights, dtype=self.dtype),
+                              np.array(pi.residual, dtype=self.dtype), pi.K)
+            else:
+                pi = topk_blocks(pi, self.topk, self.dtype)
+        else:
+            pi = np.array(pi[:], dtype=self.dtype)
+        self.pi = pi
         self.max_iteration = model['max_iteration']
         self.loglikelihoods = list(model['loglikelihoods'])
         self.timediffs = list(model['timediffs'])
+        if self.loglikelihoods:
+            self.pseudologlikelihood = self.loglikelihoods[-1]
+        # older models don't have the trainer's state, and start over with
+        # flat hyperparameters and fresh random streams
+        if 'beta' in model:
+            self.beta = np.array(model['beta'])
+            self.gamma = np.array(model['gamma'])
+            self.theta = np.array(model['theta'])
+            self.burnin = int(model['burnin'])
+            if model['seed'] >= 0:
+                self.seed = int(model['seed'])
+        set_rng_state(model)
+        self.timer.load(model)
+        model.close()
 
     def getfeaturelabels(self,file):
         self.feature_labels=open(file).read().split()
@@ -186,9 +650,13 @@ class dirichlet:
         self.a = 0
 
     def observation(self,data):
-        self.data=clip(data)
         self.J=data.shape[0]
         self.K=data.shape[1]
+        if isinstance(data, topkrows):
+            self.data=data
+            self.logdatamean=data.logmean()
+            return
+        self.data=clip(data)
         self.logdatamean=np.log(self.data).mean(axis=0)
 
     def a_update(self):
@@ -196,30 +664,91 @@ class dirichlet:
 
 
 def doccounts(docidcol):
-    counts = []
-    lastdoc = -1
-    count = 0
-    for docid in docidcol:
-        if docid != lastdoc and lastdoc != -1:
-            counts.append(count)
-            count = 0
-        count += 1
-        lastdoc = docid
-    counts.append(count)
-    return np.array(counts, float)
+    if isinstance(docidcol, tuple):
+        # a CSR corpus already knows where each document starts
+        return np.diff(docidcol[0]).astype(float)
+    # lengths of the runs of equal doc ids
+    docidcol = np.asarray(docidcol)
+    starts = np.flatnonzero(docidcol[1:] != docidcol[:-1]) + 1
+    return np.diff(np.concatenate(([0], starts, [len(docidcol)]))).astype(float)
+
+def as_csr(data):
+    """
+    Returns the (offsets, data) CSR form of a corpus. data may already be
+    in that form, or be the old four-row (doc, word, feature, count) array.
+    """
+    if isinstance(data, tuple):
+        offsets, data = data
+    else:
+        offsets = np.searchsorted(data[0], np.arange(data[0].max() + 2))
+        data = data[1:]
+    return np.asarray(offsets, dtype=np.int64), data
 
 # some random number generators
 def dirichletrnd(a,J):
     g=np.random.gamma(a,size=(J,np.shape(a)[0]))
     return row_norm(g)
 
-def dirichletrnd_array(a):
+def dirichletrnd_array(a, out=None):
     g = np.random.gamma(a + 1e-9) + 1e-10
-    return row_norm(g)
-
-def row_norm(a):
+    return row_norm(g, out=out)
+
+def dirichletrnd_rows(counts, prior, out, buf=None):
+    """
+    Samples every row of out from a Dirichlet with parameters counts + prior.
+    buf is float64 scratch space shaped like counts; the array returned
+    can be passed back in as buf on the next call.
+    """
+    if buf is None or buf.shape != counts.shape:
+        buf = np.empty(counts.shape)
+    np.add(counts, prior, out=buf)
+    buf += 1e-9
+    # RandomState can't draw into an existing array, so the draw itself is
+    # the one allocation; it becomes the next call's scratch space.
+    g = np.random.standard_gamma(buf)
+    g += 1e-10
+    row_norm(g, out=out)
+    return g
+
+def dirichletrnd_topk(prior, shape, k, dtype, counts=None):
+    """
+    Samples the J x K rows of shape from Dirichlets with parameters
+    prior + counts (prior may be a scalar), keeping
+    the top k of each (see topkrows). counts is sparse, like xmod's S:
+    (offsets, topics, counts), with row g's nonzero counts in
+    [offsets[g], offsets[g+1]). Only TOPK_BLOCK_ROWS rows are ever dense.
+    """
+    J, K = shape
+    k = min(k, K)
+    indices = np.empty((J, k), dtype=np.int32)
+    weights = np.empty((J, k), dtype=dtype)
+    residual = np.empty(J, dtype=dtype)
+    for start in xrange(0, J, TOPK_BLOCK_ROWS):
+        end = min(start + TOPK_BLOCK_ROWS, J)
+        params = np.empty((end - start, K))
+        params[:] = prior + 1e-9
+        if counts is not None:
+            offsets, topics, cts = counts
+            first, last = offsets[start], offsets[end]
+            rows = np.repeat(np.arange(end - start), np.diff(offsets[start:end + 1]))
+            used = cts[first:last] > 0
+            params[rows[used], topics[first:last][used]] += cts[first:last][used]
+        g = np.random.standard_gamma(params)
+        g += 1e-10
+        row_norm(g, out=g)
+        clip(g, out=g)
+        row_norm(g, out=g)
+        block = topk(g, k)
+        indices[start:end] = block.indices
+        weights[start:end] = block.weights
+        residual[start:end] = block.residual
+    return topkrows(indices, weights, residual, K)
+
+def row_norm(a, out=None):
     row_sums = a.sum(axis=1)
-    return a / row_sums[:, np.newaxis]
+    if out is None:
+        return a / row_sums[:, np.newaxis]
+    return np.divide(a, row_sums[:, np.newaxis], out=out)
 
 # IO Stuff
 def itersplit(s, sub):
@@ -233,73 +762,118 @@ def itersplit(s, sub):
             yield s[pos:i]
             pos = i + len(sub)
 
-def parse_item(item):
-    item = item.strip()
-    if "," in item:
-        left, tworight = item.split(",")
-        retval = [left] + tworight.split(":")
-    else:
-        retval = item.split(":")
-    return map(int, retval)
-
-def clip(arr):
-  return np.clip(arr, 1e-10, 1 - 1e-10)
-
-def dataread(file):
+def parse_chunk(lines, dims=2):
+    # every item becomes a (word, feature, ..., count) tuple of dims ids and
+    # a count; ids an item leaves out are the null feature 0.
+    text = "".join(lines)
+    for k in xrange(1, dims):
+        text = re.sub(SHORT_ITEM % (k - 1), r"\1\2" + ",0" * (dims - k) + ":", text)
+    values = np.fromstring(text.replace(",", " ").replace(":", " "), dtype=np.int32, sep=" ")
+    lengths = np.array([line.count(":") for line in lines], dtype=np.int32)
+    if len(values) != (dims + 1) * lengths.sum():
+        raise ValueError("Malformed corpus chunk: expected %d values, got %d." % ((dims + 1) * lengths.sum(), len(values)))
+    return lengths, values.reshape(-1, dims + 1)
+
+def datadims(file):
+    """
+    The number of ids in the widest item of an Andrews-format corpus: the
+    word, and however many features. Every pass over the file is a regex
+    search, so this is about as fast as reading it, and the last search
+    always reads all of it. So, like dataread's binary file, the answer is
+    kept in file.dims until the corpus changes.
+    """
+    if not os.path.getsize(file):
+        return 1
+    cache = file + ".dims"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(file):
+        return int(open(cache).read())
+    data_file = open(file)
+    text = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+    dims = 1
+    while re.search(r"\d+(?:,\d+){%d}:" % dims, text):
+        dims += 1
+    text.close()
+    data_file.close()
+    with replaced(cache) as f:
+        f.write("%d\n" % dims)
+    return dims
+
+def clip(arr, out=None):
+  return np.clip(arr, 1e-10, 1 - 1e-10, out=out)
+
+@contextmanager
+def replaced(filename):
+    """
+    Writes filename by way of a temporary file next to it, which is renamed
+    into place once it's complete. Processes that have the old file open or
+    mapped keep reading the old one, and nobody opens a half-written file.
+    """
+    tmp = "%s.%s.%d.tmp" % (filename, socket.gethostname(), os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def dataread(file, dims=2):
+    """
+    Reads an Andrews-format corpus in CSR form, as the tuple (offsets, data).
+    The tokens of document g are data[:, offsets[g]:offsets[g+1]], with
+    data[0] the words, data[1] the features and data[2] the counts. Corpora
+    with more feature modalities (dims > 2) have a row per modality, and the
+    counts last.
+    """
+    binary = dims == 2 and file or "%s.%dd" % (file, dims)
     try:
-        if os.path.getmtime(file + ".npy") < os.path.getmtime(file):
+        if min(os.path.getmtime(binary + ".npy"), os.path.getmtime(binary + ".offsets.npy")) < os.path.getmtime(file):
             logging.info("The corpus file is newer than the binary file. Recreating it...")
         else:
-            return np.load(file + ".npy").T
+            data = np.load(binary + ".npy", mmap_mode="r")
+            if data.shape[0] == dims + 1:
+                return np.load(binary + ".offsets.npy", mmap_mode="r"), data
+            logging.info("The binary file uses an old layout. Recreating it...")
+            del data
     except (IOError, OSError):
         logging.info("Binary file has not been created; creating it.")
         pass
 
-    tmpfile = open(file + ".npy", "wb")
-
-    tmpfile.write("\x93\x4e\x55\x4d\x50\x59\x01\x00\x46\x00")
+    # stored column-major so the word, feature and count rows are each
+    # contiguous.
+    data = np.empty((dims + 1, READ_CHUNK_ROWS), dtype=np.int32)
+    doc_lengths = []
+    rows = 0
 
-    data_file=open(file)
-    row_count = 0
-    logging.warning("Starting to read data (pass 1)...")
-    for doc_id, doc in enumerate(data_file):
-        for item in itersplit(doc, " "):
-            if item.strip():
-                row_count += 1
+    logging.warning("Starting to read data...")
+    data_file = open(file)
+    while True:
+        lines = data_file.readlines(READ_CHUNK_SIZE)
+        if not lines:
+            break
+        lengths, items = parse_chunk(lines, dims)
+        while rows + len(items) > data.shape[1]:
+            # amortized doubling so we only need the one pass
+            grown = np.empty((dims + 1, 2 * data.shape[1]), dtype=data.dtype)
+            grown[:, :rows] = data[:, :rows]
+            data = grown
+        data[:, rows:rows + len(items)] = items.T
+        doc_lengths.append(lengths)
+        rows += len(items)
+        logging.info("Processed %d docs (%d rows)" % (sum(map(len, doc_lengths)), rows))
     data_file.close()
-    num_docs = doc_id + 1
-
-    # okay let's go through this again
-    # start writing the header.
-    header = "{'descr': '<i8', 'fortran_order': False, 'shape': (%d, %d), }" % (row_count, 4)
-    header = ("%-69s\x0a" % header)
-    tmpfile.write(header)
-
-    # so far recognizes two data-types, lda and combinatorial lda
-    data_file=open(file)
-
-    logging.warning("Starting to read data (pass 2)...")
-    rows_written = 0
-    for doc_id, doc in enumerate(data_file):
-        if (doc_id + 1) % 1000 == 0:
-            logging.info("Processing doc %d/%d (%4.2f%%)" % (doc_id + 1, num_docs, 100 * float(rows_written) / row_count))
-        for item in itersplit(doc, " "):
-            if not item.strip():
-                continue
-            splitted = parse_item(item)
-            if len(splitted) == 2:
-                feat_id = 0
-                word_id, count = splitted
-            elif len(splitted) == 3:
-                word_id, feat_id, count = splitted
-
-            outs = struct.pack("<QQQQ", doc_id, word_id, feat_id, count)
-            rows_written += 1
-            tmpfile.write(outs)
-
-    tmpfile.close()
-    data = np.load(tmpfile.name)
-    del tmpfile
-
-    return data.T
 
+    offsets = np.zeros(sum(map(len, doc_lengths)) + 1, dtype=np.int64)
+    if doc_lengths:
+        np.cumsum(np.concatenate(doc_lengths), out=offsets[1:])
+    # other jobs may have the old binary file mapped. the data goes first
+    # and the offsets last, so the offsets being newer than the corpus
+    # means both are complete.
+    with replaced(binary + ".npy") as f:
+        np.save(f, data[:, :rows])
+    with replaced(binary + ".offsets.npy") as f:
+        np.save(f, offsets)
+    del data, offsets
+
+    return np.load(binary + ".offsets.npy", mmap_mode="r"), np.load(binary + ".npy", mmap_mode="r")
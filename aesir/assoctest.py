@@ -7,7 +7,7 @@ import logging
 import scipy.stats
 from itertools import izip
 from nicemodel import load_labels
-from aesir import row_norm
+from aesir import row_norm, modelfile
 
 logging.basicConfig(
     format="[ %(levelname)-10s %(module)-8s %(asctime)s  %(relativeCreated)-10d ]  %(message)s",
@@ -83,7 +83,7 @@ def main():
     #                    help='The document labels.')
     args = parser.parse_args()
 
-    model = np.load(args.model)
+    model = modelfile(args.model)
     phi = row_norm(np.ascontiguousarray(model["phi"].T))
     #pi = safe_pi_read(args.model)
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import logging
+import argparse
+import time
+
+import numpy as np
+
+import aesir
+import xmod
+
+logging.basicConfig(
+    format="[ %(levelname)-10s %(module)-8s %(asctime)s  %(relativeCreated)-10d ]  %(message)s",
+    datefmt="%H:%M:%S:%m",
+    level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='Times model initialization and one posterior sweep at several K.')
+    parser.add_argument('--input', '-i', metavar='FILE',
+                        help='The corpus (in Andrews format).')
+    parser.add_argument('--topics', '-k', metavar='INT', type=int, nargs='+', default=[100, 250, 500],
+                        help='The numbers of topics to try.')
+    parser.add_argument('--threads', '-t', metavar='INT', default=4, type=int,
+                        help='The number of separate threads to run.')
+    parser.add_argument('--float32', action='store_true',
+                        help='Keep the model parameters in single precision.')
+    parser.add_argument('--seed', metavar='INT', type=int, default=0,
+                        help='Seed for the random number generators.')
+    args = parser.parse_args()
+
+    logging.info("Loading data...")
+    data = aesir.dataread(args.input)
+    dtype = args.float32 and np.float32 or np.float64
+
+    print "k,init,posterior"
+    for k in args.topics:
+        np.random.seed(args.seed)
+        tic = time.time()
+        model = aesir.freyr(data, K=k, dtype=dtype)
+        init_took = time.time() - tic
+
+        xmod.initialize(args.threads, k, 4096, args.seed)
+        tic = time.time()
+        model.fast_posterior()
+        posterior_took = time.time() - tic
+        xmod.finalize()
+
+        print "%d,%f,%f" % (k, init_took, posterior_took)
+
+
+if __name__ == '__main__':
+    main()
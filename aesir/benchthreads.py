@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import logging
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+import aesir
+import xmod
+
+logging.basicConfig(
+    format="[ %(levelname)-10s %(module)-8s %(asctime)s  %(relativeCreated)-10d ]  %(message)s",
+    datefmt="%H:%M:%S:%m",
+    level=logging.INFO)
+
+
+def default_thread_counts():
+    # powers of two up to the core count, and the core count itself
+    cores = multiprocessing.cpu_count()
+    counts = []
+    t = 1
+    while t < cores:
+        counts.append(t)
+        t *= 2
+    counts.append(cores)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='Measures how the sampler scales with the number of threads.')
+    parser.add_argument('--input', '-i', metavar='FILE',
+                        help='The corpus (in Andrews format).')
+    parser.add_argument('--topics', '-k', metavar='INT', default=100, type=int,
+                        help='The number of topics.')
+    parser.add_argument('--iterations', '-I', metavar='INT', default=5, type=int,
+                        help='Number of iterations to time for each thread count.')
+    parser.add_argument('--threads', '-t', metavar='INT', type=int, nargs='+',
+                        help='The thread counts to try. (Default powers of two up to the core count)')
+    parser.add_argument('--chunksize', metavar='INT', default=4096, type=int,
+                        help='Roughly how many token rows a thread works on at a time.')
+    parser.add_argument('--float32', action='store_true',
+                        help='Keep the model parameters in single precision.')
+    parser.add_argument('--topk', metavar='INT', type=int, default=0,
+                        help="Only keep each document's this many best topics. (Default all)")
+    parser.add_argument('--sampler', choices=aesir.SAMPLERS, default='dense',
+                        help='The sampler to time. alias needs --topk.')
+    parser.add_argument('--seed', metavar='INT', type=int, default=0,
+                        help='Seed for the random number generators. Every thread count should draw the same samples.')
+    args = parser.parse_args()
+    if args.sampler == "alias" and not args.topk:
+        parser.error("the alias sampler needs --topk")
+
+    logging.info("Loading data...")
+    data = aesir.dataread(args.input)
+    model = aesir.freyr(data, K=args.topics, dtype=args.float32 and np.float32 or np.float64, topk=args.topk)
+    model.sampler = args.sampler
+    # every thread count starts from the same parameters. fast_posterior
+    # updates them in place, so keep copies.
+    start = (model.phi.copy(), model.psi.copy(), model.pi.copy())
+
+    results = []
+    for threads in args.threads or default_thread_counts():
+        model.phi, model.psi, model.pi = [param.copy() for param in start]
+        np.random.seed(args.seed)
+        xmod.initialize(threads, model.K, args.chunksize, args.seed)
+        # one untimed iteration to warm up the page cache
+        model.fast_posterior()
+        tic = time.time()
+        for i in xrange(args.iterations):
+            model.fast_posterior()
+        took = (time.time() - tic) / args.iterations
+        xmod.finalize()
+        logging.info("%d threads: %f s/iteration" % (threads, took))
+        # the same seed gives the same samples, so this should only differ
+        # between thread counts if something's wrong.
+        results.append((threads, took, model.pseudologlikelihood))
+
+    base_threads, base_took, base_ll = results[0]
+    print "threads,seconds,speedup,efficiency,loglikelihood"
+    for threads, took, ll in results:
+        speedup = base_took / took
+        print "%d,%f,%f,%f,%f" % (threads, took, speedup, speedup * base_threads / threads, ll)
+
+
+if __name__ == '__main__':
+    main()
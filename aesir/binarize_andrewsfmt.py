@@ -8,8 +8,10 @@ def main():
             description='Writes a binary version of an Andrews format corpus.')
     parser.add_argument('--input', '-i', metavar='FILE',
                         help='The input corpus (in Andrews format).')
+    parser.add_argument('--dims', '-d', metavar='INT', type=int, default=2,
+                        help='How many ids (word, features...) each item has.')
     args = parser.parse_args()
-    aesir.dataread(args.input)
+    aesir.dataread(args.input, args.dims)
 
 if __name__ == '__main__':
     main()
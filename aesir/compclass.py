@@ -9,7 +9,7 @@ import pandas as pd
 import scipy.stats
 import logging
 from itertools import combinations
-from aesir import row_norm
+from aesir import row_norm, modelfile
 from assoctest import jsdiv, kldiv, symkldiv
 from nicemodel import load_labels
 
@@ -214,11 +214,20 @@ def main():
     model_evaluations = []
     for model in args.models:
         logging.info("Processing model '%s'..." % model)
-        m = np.load(model)
+        m = modelfile(model)
         k = m['k']
-        ll = np.mean('loglikelihoods' in m and m['loglikelihoods'][-5:] or m['perwordbounds'][-5:])
+        if 'loglikelihoods' in m:
+            ll = np.mean(m['loglikelihoods'][-5:])
+        else:
+            # iterations without a bound estimate have nan
+            bounds = m['perwordbounds']
+            ll = np.mean(bounds[np.isfinite(bounds)][-5:])
         iter = m['max_iteration']
-        time = np.sum(m['timediffs'])
+        timediffs = m['timediffs']
+        if timediffs.ndim > 1:
+            # OnlineLDA keeps a row per iteration, its seconds first
+            timediffs = timediffs[:, 0]
+        time = np.sum(timediffs)
         phi = np.ascontiguousarray(m['phi'])
         topic_normed = row_norm(phi)
         word_normed = col_norm(phi)
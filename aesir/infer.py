@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import logging
+import argparse
+import multiprocessing
+from itertools import islice, imap
+
+import numpy as np
+
+from aesir import modelfile, parse_chunk, row_norm, topk, topkrows, READ_CHUNK_SIZE
+from onlineldavb import fold_in, dirichlet_expectation_2, table_key, ignore_interrupts
+
+logging.basicConfig(
+    format="[ %(levelname)-10s %(module)-8s %(asctime)s  %(relativeCreated)-10d ]  %(message)s",
+    datefmt="%H:%M:%S:%m",
+    level=logging.INFO)
+
+# what the workers inherit when they're forked: the model's expectations,
+# computed once.
+_model = {}
+
+
+def load_model(filename):
+    """
+    Reads the topics of a model saved by OnlineLDA: the E[log] of each
+    modality's topics (phi, psi, psi2, ...), K and alpha.
+    """
+    model = modelfile(filename)
+    Elogs = []
+    while table_key(len(Elogs)) in model:
+        Elogs.append(dirichlet_expectation_2(np.asarray(model[table_key(len(Elogs))])))
+    return Elogs, int(model['k']), float(model['alpha'])
+
+
+def count_lines(filename):
+    lines = 0
+    last = "\n"
+    with open(filename) as f:
+        for block in iter(lambda: f.read(READ_CHUNK_SIZE), ""):
+            lines += block.count("\n")
+            last = block[-1]
+    return lines + (last != "\n")
+
+
+def chunks(filename, chunksize):
+    with open(filename) as f:
+        while True:
+            lines = list(islice(f, chunksize))
+            if not lines:
+                break
+            yield lines
+
+
+def infer_chunk(task):
+    lines, seed = task
+    np.random.seed(seed)
+    Elogs = _model['Elogs']
+    lengths, items = parse_chunk(lines, len(Elogs))
+    ids = items[:, :-1].T
+    # ids the model has never seen tell us nothing, so those tokens go
+    known = np.ones(len(items), dtype=bool)
+    for Elog, modality_ids in zip(Elogs, ids):
+        known &= modality_ids < Elog.shape[1]
+    docs = np.repeat(np.arange(len(lengths)), lengths)
+    lengths = np.bincount(docs[known], minlength=len(lengths))
+    docs = (lengths, items[known, -1]) + tuple(ids[:, known])
+    gamma, expElogtheta, iterations = fold_in(docs, Elogs, _model['k'], _model['alpha'])
+    if not _model['gamma']:
+        gamma = row_norm(gamma)
+    gamma = gamma.astype(_model['dtype'])
+    if _model['topk']:
+        # only the top topics go back to the master
+        return topk(gamma, _model['topk'])
+    return gamma
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='Infers the topic mixtures of unseen documents under a trained OnlineLDA model.')
+    parser.add_argument('--model', '-m', metavar='FILE',
+                        help='The trained model.')
+    parser.add_argument('--input', '-i', metavar='FILE',
+                        help='The documents (in Andrews format).')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Save the documents x topics matrix here (.npy, or .npz with --topk).')
+    parser.add_argument('--workers', '-w', metavar='INT', type=int, default=multiprocessing.cpu_count(),
+                        help='Split the documents between this many processes.')
+    parser.add_argument('--chunksize', metavar='INT', type=int, default=1024,
+                        help='How many documents a worker takes at a time.')
+    parser.add_argument('--gamma', action='store_true',
+                        help="Save the variational parameters gamma, instead of the mixtures they're normalized to.")
+    parser.add_argument('--topk', metavar='INT', type=int, default=0,
+                        help="Only keep each document's this many best topics. (Default all)")
+    parser.add_argument('--float32', action='store_true',
+                        help='Save the matrix in single precision.')
+    parser.add_argument('--randomseed', metavar='INT', type=int, default=0,
+                        help='Supply the seed for the random number generator.')
+    args = parser.parse_args()
+
+    logging.info("Loading model...")
+    Elogs, k, alpha = load_model(args.model)
+    dtype = args.float32 and np.float32 or np.float64
+    _model.update(Elogs=Elogs, k=k, alpha=alpha, gamma=args.gamma, topk=args.topk, dtype=dtype)
+    logging.info("%d topics, %d modalities." % (k, len(Elogs)))
+
+    D = count_lines(args.input)
+    if args.topk:
+        # the same layout as freyr's top-k pi, so modelfile.rows reads it
+        out = topkrows(np.empty((D, min(args.topk, k)), dtype=np.int32), np.empty((D, min(args.topk, k)), dtype=dtype),
+                       np.empty(D, dtype=dtype), k)
+    else:
+        out = np.lib.format.open_memmap(args.output, mode='w+', dtype=dtype, shape=(D, k))
+
+    # every chunk gets its own stream, so the results don't depend on
+    # the number of workers
+    rng = np.random.RandomState(args.randomseed)
+    tasks = ((lines, rng.randint(2**31)) for lines in chunks(args.input, args.chunksize))
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, ignore_interrupts)
+        results = pool.imap(infer_chunk, tasks)
+    else:
+        pool = None
+        results = imap(infer_chunk, tasks)
+
+    done = 0
+    try:
+        for gamma in results:
+            if args.topk:
+                out.indices[done:done + len(gamma)] = gamma.indices
+                out.weights[done:done + len(gamma)] = gamma.weights
+                out.residual[done:done + len(gamma)] = gamma.residual
+            else:
+                out[done:done + len(gamma)] = gamma
+            done += len(gamma)
+            logging.info("Inferred %d/%d documents." % (done, D))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if args.topk:
+        np.savez(args.output, **out.arrays("pi"))
+    else:
+        out.flush()
+    del out
+
+
+if __name__ == '__main__':
+    main()
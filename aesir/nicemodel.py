@@ -5,7 +5,7 @@ import argparse
 import numpy as np
 import sys
 import codecs
-from aesir import row_norm
+from aesir import row_norm, modelfile
 
 sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 
@@ -62,13 +62,16 @@ def main():
                         help="Don't norm the probabilities to be conditional distributions.")
     args = parser.parse_args()
 
-    model = np.load(args.model)
+    model = modelfile(args.model)
     #from onlineldavb import dirichlet_expectation
     phi = row_norm(np.ascontiguousarray(model['phi']))
     #phi = np.ascontiguousarray(model['expElogbeta'])
     #phi = np.exp(dirichlet_expectation(phi))
     psi = row_norm(np.ascontiguousarray(model['psi']))
-    psi2 = row_norm(np.ascontiguousarray(model['psi2']))
+    # only models with a second feature modality have psi2
+    psi2 = None
+    if 'psi2' in model:
+        psi2 = row_norm(np.ascontiguousarray(model['psi2']))
 
     label_vocab = load_labels(args.vocab)
     label_features = load_labels(args.features)
@@ -86,7 +89,6 @@ def main():
         for k in xrange(model['k']):
             bestphi = ranked_list(phi[k], TOPIC_WORDS_SHOW)
             bestpsi = ranked_list(psi[k], TOPIC_FEATS_SHOW)
-            bestpsi2 = ranked_list(psi2[k], TOPIC_FEATS_SHOW)
 
             topic_str = []
             topic_str.append("Topic %d:" % k)
@@ -96,9 +98,10 @@ def main():
             topic_str.append("  Psi (features):")
             for i, p in bestpsi:
                 topic_str.append("    %.5f  %s" % (p, label_features.get(i, "feat_%d" % i)))
-            topic_str.append("  Psi2 (features):")
-            for i, p in bestpsi2:
-                topic_str.append("    %.5f  %s" % (p, label_features2.get(i, "feat2_%d" % i)))
+            if psi2 is not None:
+                topic_str.append("  Psi2 (features):")
+                for i, p in ranked_list(psi2[k], TOPIC_FEATS_SHOW):
+                    topic_str.append("    %.5f  %s" % (p, label_features2.get(i, "feat2_%d" % i)))
 
             if args.topics:
                 print '\n'.join(topic_str)
@@ -113,12 +116,15 @@ def main():
         docids = (d[:d.rindex('/')] for d in docids)
         docids = {dname: dnum for dnum, dname in enumerate(docids)}
         whitedocs = list(codecs.getreader('utf-8')(open(args.docs)).read().split())
+        # only the rows we look at get read, if pi is stored uncompressed.
+        # pi may be saved as each document's top topics, see topkrows.
+        pi = model.rows('pi')
         for docname in whitedocs:
             try:
                 docid = docids[docname]
             except KeyError:
                 pass
-            docdist = model['pi'][docid]
+            docdist = pi[docid]
             if not args.detailedtopics:
                 docdist_s = ' '.join(map(repr, docdist))
                 #print "%s\t%s" % (docname, docdist_s)
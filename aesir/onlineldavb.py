@@ -26,11 +26,15 @@ import numpy as n
 import logging
 import argparse
 import os
+import signal
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 from collections import Counter
 #from xmod import vdigamma as psi, vlngamma as gammaln
 from scipy.special import gammaln, psi
+from scipy.sparse import coo_matrix
 from random import sample, seed
-from aesir import itersplit, row_norm, ONE_HOUR, QUARTER_HOUR
+from aesir import itersplit, row_norm, checkpointer, phasetimer, stopsignal, rng_state, set_rng_state, dataread, datadims, ONE_HOUR, QUARTER_HOUR
 
 SAVE_FREQUENCY = ONE_HOUR
 
@@ -41,9 +45,12 @@ logging.basicConfig(
 
 MEAN_CHANGE_THRESH = 0.001
 DEBUG = False
-
-def parse_doc_list(docs):
-    return docs
+SCHEDULES = ("random", "epoch", "stratified")
+WARM_DTYPES = ("float16", "float32")
+# any timeout at all lets a KeyboardInterrupt through while we wait on workers
+WORKER_TIMEOUT = 365 * 24 * 60 * 60
+# what an iteration's time is split into; the scatter is part of the E step
+PHASES = ("minibatch", "expect", "estep", "scatter", "mstep", "bound", "save")
 
 def dirichlet_expectation_2(alpha):
     """
@@ -58,39 +65,470 @@ def dirichlet_expectation_1(alpha):
     return (psi(alpha) - psi(n.sum(alpha)))
 
 
-def remove_redundancies(ids, update_matrix):
-    # in our E step, we'll need to update the feature and word ids with
-    # the updates. However, we can't just simply use fancy indexing,
-    # because redundancies in the matrix cause the second update of
-    # the same ID to get ignored. Our goal here is to reduce the size
-    # of this matrix so we can use the fancy indexing.
-    uniq_ids = list(set(ids))
-    uniq_ids_d = { id_: new_i for new_i, id_ in enumerate(uniq_ids) }
-    update_matrix_uniq = n.zeros(len(uniq_ids))
-    for old_i, id_ in enumerate(ids):
-        col = update_matrix[old_i]
-        new_id = uniq_ids_d[id_]
-        update_matrix_uniq[new_id] += col
-    return uniq_ids, update_matrix_uniq
+def sufficient_stats(tokendocs, ids, cts, expElogtheta, expElogX):
+    """
+    Computes a whole mini-batch's contribution to the sufficient statistics
+    of one modality at once. For every token t, in document d = tokendocs[t]
+    with id i = ids[t], column i of the K x width statistics gets
+        cts[t] * expElogtheta[d] * expElogX[:, i] / (expElogtheta[d] . expElogX[:, i]),
+    i.e. n_{di} * phi_{dik}. Repeated ids within or across documents simply
+    add up, so there's no need to merge them first; the scatter is a sparse
+    matrix product.
+
+    Only the columns of ids the mini-batch saw are nonzero, so this returns
+    them, and the K x len(cols) block of statistics, as (cols, stats).
+    """
+    cols, rows = n.unique(ids, return_inverse=True)
+    phinorm = n.einsum('nk,nk->n', expElogtheta[tokendocs], expElogX.T[ids])
+    weights = coo_matrix((cts / phinorm, (rows, tokendocs)),
+                         shape=(len(cols), expElogtheta.shape[0])).tocsr()
+    return cols, weights.dot(expElogtheta).T * expElogX[:, cols]
+
+
+def fixed_point(lengths, cts, likelihoods, gamma, alpha, iterations=None):
+    """
+    Iterates between gamma and phi until convergence, for a whole mini-batch
+    in CSR form: document d has lengths[d] tokens, with counts cts and
+    likelihoods (everything but the theta factor of phi, one row per token).
+    Updates gamma in place, and returns exp(E[log theta]). If given,
+    iterations[d] gets the number of iterations document d took.
+
+    Document lengths vary by orders of magnitude, so the documents are
+    bucketed by length, up to the next power of two, and each bucket is
+    padded out to a dense (documents x length x K) array, with zero counts
+    masking the padding. An iteration is then a batched matrix product per
+    bucket, and the documents that converge drop out of their bucket.
+    """
+    K = gamma.shape[1]
+    expElogtheta = n.exp(dirichlet_expectation_2(gamma))
+    indptr = n.concatenate(([0], n.cumsum(lengths)))
+    buckets = n.ceil(n.log2(n.maximum(lengths, 1))).astype(int)
+    for bucket in n.unique(buckets):
+        docs = n.flatnonzero(buckets == bucket)
+        positions = n.arange(lengths[docs].max())
+        mask = positions < lengths[docs][:, n.newaxis]
+        tokens = (indptr[docs][:, n.newaxis] + positions)[mask]
+        padded = n.zeros(mask.shape + (K,))
+        padded[mask] = likelihoods[tokens]
+        padded_cts = n.zeros(mask.shape)
+        padded_cts[mask] = cts[tokens]
+
+        for it in range(0, 100):
+            expElogthetab = expElogtheta[docs]
+            # phinorm is the normalizer.
+            phinorm = n.matmul(padded, expElogthetab[:, :, n.newaxis])[:, :, 0] + 1e-100
+
+            # We represent phi implicitly to save memory and time.
+            # Substituting the value of the optimal phi back into
+            # the update for gamma gives this update. Cf. Lee&Seung 2001.
+            lastgamma = gamma[docs]
+            gammab = alpha + expElogthetab * n.matmul((padded_cts / phinorm)[:, n.newaxis, :], padded)[:, 0, :]
+            gamma[docs] = gammab
+            expElogtheta[docs] = n.exp(dirichlet_expectation_2(gammab))
+
+            # If gamma hasn't changed much, a document's done.
+            meanchange = n.sum(n.abs(gammab - lastgamma), axis=1)
+            converged = meanchange < K * MEAN_CHANGE_THRESH
+            if iterations is not None:
+                iterations[docs] = it + 1
+            if converged.all():
+                break
+            if converged.any():
+                still_active = ~converged
+                docs = docs[still_active]
+                padded = padded[still_active]
+                padded_cts = padded_cts[still_active]
+
+    return expElogtheta
+
+
+def fold_in(docs, Elogs, K, alpha, start=None):
+    """
+    The E step for a mini-batch of documents (see minibatch), given the
+    expectations E[log beta], E[log pi], ... of each modality's topics.
+    Returns gamma, the documents' variational parameters for theta,
+    exp(E[log theta]), and how many iterations each document took.
+
+    Documents start from a random gamma, or from their row of start, if
+    there is one and it isn't nan (see gammacache).
+    """
+    (lengths, cts) = docs[:2]
+
+    # Initialize the variational distribution q(theta|gamma) for
+    # the mini-batch
+    gamma = 1 * n.random.gamma(100., 1./100., (len(lengths), K))
+    if start is not None:
+        warm = ~n.isnan(start[:, 0])
+        gamma[warm] = start[warm]
+
+    # The optimal phi_{dwk} is proportional to
+    #    expElogthetad_k * expElogbetad_w * expElogpid_f = exp { Elogthetad_k + Elogbetad_w  + Elogpid_f }
+    # likelihoods holds everything but the theta factor, one row per token.
+    logs = Elogs[0].T[docs[2]]
+    for Elog, ids in zip(Elogs[1:], docs[3:]):
+        logs += Elog.T[ids]
+    likelihoods = n.exp(logs)
+
+    # Iterate between gamma and phi until convergence
+    iterations = n.zeros(len(lengths), dtype=int)
+    expElogtheta = fixed_point(lengths, cts, likelihoods, gamma, alpha, iterations)
+    return gamma, expElogtheta, iterations
+
+
+class gammacache:
+    """
+    The last gamma of up to capacity documents, by their row in the corpus,
+    so the E step can start from there when we see them again rather than
+    from scratch. The gammas are only a starting point, so they're kept
+    in float16 or float32, and the least recently used documents make room
+    for new ones.
+    """
+
+    def __init__(self, D, capacity, K, dtype=n.float16):
+        self.gammas = n.zeros((min(capacity, D), K), dtype=dtype)
+        self.slot_of = -n.ones(D, dtype=n.int64)
+        self.doc_of = -n.ones(len(self.gammas), dtype=n.int64)
+        self.last_used = n.zeros(len(self.gammas), dtype=n.int64)
+        self.clock = 0
+
+    def lookup(self, ids):
+        """
+        The documents' gammas, as fold_in's start: nan rows for the
+        documents we don't have.
+        """
+        slots = self.slot_of[ids]
+        start = n.empty((len(slots), self.gammas.shape[1]))
+        start[:] = n.nan
+        start[slots >= 0] = self.gammas[slots[slots >= 0]]
+        return start
+
+    def store(self, ids, gamma):
+        ids = n.asarray(ids)
+        self.clock += 1
+        slots = self.slot_of[ids]
+        self.last_used[slots[slots >= 0]] = self.clock
+        new = ids[slots < 0][-len(self.gammas):]
+        if len(new):
+            # evict the least recently used
+            free = n.argpartition(self.last_used, len(new) - 1)[:len(new)]
+            evicted = self.doc_of[free]
+            self.slot_of[evicted[evicted >= 0]] = -1
+            self.doc_of[free] = new
+            self.slot_of[new] = free
+            self.last_used[free] = self.clock
+        slots = self.slot_of[ids]
+        kept = slots >= 0
+        self.gammas[slots[kept]] = n.minimum(gamma[kept], n.finfo(self.gammas.dtype).max)
+
+    def arrays(self):
+        return dict(warm_gammas=self.gammas, warm_docs=self.doc_of,
+                    warm_last_used=self.last_used, warm_clock=self.clock)
+
+    def load(self, model):
+        self.gammas[:] = model['warm_gammas']
+        self.doc_of[:] = model['warm_docs']
+        self.last_used[:] = model['warm_last_used']
+        self.clock = int(model['warm_clock'])
+        self.slot_of[:] = -1
+        self.slot_of[self.doc_of[self.doc_of >= 0]] = n.flatnonzero(self.doc_of >= 0)
+
+
+class lazydirichlet:
+    """
+    The K x W variational parameters lambda of one modality's topics, with
+    their expectations Elog = E[log beta] and expElog = exp(Elog).
+
+    The online update decays all of lambda towards the prior, but only adds
+    mass to the columns a mini-batch saw. So lambda is kept as
+    scale * raw + shift, with the decay folded into the two scalars, and an
+    update only writes the columns it touched. The row sums are kept up to
+    date as we go. Elog and expElog are only recomputed for the columns a
+    mini-batch is about to use (expect).
+    """
+
+    def __init__(self, lam):
+        self.raw = lam
+        self.scale = 1.0
+        self.shift = 0.0
+        self.rowsums = lam.sum(1)
+        self.Elog = dirichlet_expectation_2(lam)
+        self.expElog = n.exp(self.Elog)
+        # (prior, prior_term(prior)), until lambda changes
+        self._prior_term = None
+
+    def value(self):
+        return self.scale * self.raw + self.shift
+
+    def share(self):
+        # the expectations move to shared memory, for the E-step workers
+        self.Elog = shared_array(self.Elog)
+        self.expElog = shared_array(self.expElog)
+
+    def update(self, rhot, prior, cols, stats):
+        """
+        lambda <- (1 - rhot) * lambda + rhot * (prior + stats), where stats
+        is zero outside of the columns cols.
+        """
+        W = self.raw.shape[1]
+        self._prior_term = None
+        self.scale *= 1 - rhot
+        self.shift = (1 - rhot) * self.shift + rhot * prior
+        self.raw[:, cols] += (rhot / self.scale) * stats
+        self.rowsums = (1 - rhot) * self.rowsums + rhot * (prior * W + stats.sum(1))
+        if self.scale < 1e-100:
+            # fold the scale back in before it underflows
+            self.raw[:] = self.value()
+            self.scale, self.shift = 1.0, 0.0
+
+        # hardcode equal probability for each of the zero words. technically this isn't necessary.
+        null = self.scale * self.raw[:, 0] + self.shift
+        if W > 1:
+            mean = (self.rowsums.sum() - null.sum()) / (len(null) * (W - 1))
+        else:
+            mean = self.rowsums.sum() / len(null)
+        self.raw[:, 0] = (mean - self.shift) / self.scale
+        self.rowsums += mean - null
+
+    def expect(self, ids):
+        """
+        Brings Elog and expElog up to date for the columns ids.
+        """
+        cols = n.unique(ids)
+        Elog = psi(self.scale * self.raw[:, cols] + self.shift) - psi(self.rowsums)[:, n.newaxis]
+        self.Elog[:, cols] = Elog
+        self.expElog[:, cols] = n.exp(Elog)
+
+    def arrays(self, key):
+        """
+        lambda itself as key, for whoever reads the model, and what we keep
+        of it as key_raw, key_scale, key_shift and key_rowsums, so training
+        can continue exactly where it left off.
+        """
+        arrays = {key: self.value(), key + "_scale": self.scale, key + "_shift": self.shift,
+                  key + "_rowsums": self.rowsums}
+        if self.scale != 1.0 or self.shift != 0.0:
+            arrays[key + "_raw"] = self.raw
+        return arrays
+
+    def load(self, model, key):
+        # older models only have lambda itself
+        if key + "_rowsums" in model.files:
+            if key + "_raw" in model.files:
+                self.raw = model[key + "_raw"]
+            self.scale = float(model[key + "_scale"])
+            self.shift = float(model[key + "_shift"])
+            self.rowsums = model[key + "_rowsums"]
+
+    def prior_term(self, prior):
+        """
+        E[log p(beta | prior) - log q(beta | lambda)], summed over the topics.
+        This is a pass over all of lambda, so it's kept until the next update.
+        """
+        if self._prior_term is None or self._prior_term[0] != prior:
+            lam = self.value()
+            Elog = dirichlet_expectation_2(lam)
+            score = n.sum((prior - lam) * Elog)
+            score += n.sum(gammaln(lam) - gammaln(prior))
+            score += n.sum(gammaln(prior * lam.shape[1]) - gammaln(n.sum(lam, 1)))
+            self._prior_term = (prior, score)
+        return self._prior_term[1]
+
+
+def minibatch(corpus, docset_ids):
+    """
+    Gathers the documents docset_ids of a CSR corpus (see read_andrews) into
+    a mini-batch: the tuple (lengths, cts, wids, fids, ...) of the documents'
+    token counts and their tokens' counts and ids, one flat array each.
+    """
+    offsets, data = corpus
+    docset_ids = n.asarray(docset_ids)
+    starts = offsets[docset_ids]
+    lengths = offsets[docset_ids + 1] - starts
+    ends = n.cumsum(lengths)
+    tokens = n.arange(ends[-1]) + n.repeat(starts - (ends - lengths), lengths)
+    rows = data[:, tokens]
+    return (lengths, rows[-1]) + tuple(rows[:-1])
+
+
+class epochscheduler:
+    """
+    Hands out mini-batches that cover the documents exactly once per epoch.
+    The documents are cut into blocks of blocksize neighbours, which are
+    shuffled and laid end to end, and each mini-batch is the next batchsize
+    documents of that order: a few whole blocks and part of the next, so we
+    read the corpus in runs instead of one scattered document at a time.
+    Only the last mini-batch of an epoch can be smaller. The blocks are
+    reshuffled every epoch from (seed, epoch), so the schedule can be
+    picked up again from the seed, the epoch and the cursor, the
+    mini-batches done this epoch.
+
+    With stratify, the blocks are ranked by their number of tokens and cut
+    into bands, and every mini-batch gets about a block from each band, so
+    the mini-batches (and their shards) cost about the same.
+    """
+
+    def __init__(self, population, lengths, batchsize, blocksize=16, stratify=False, seed=0, epoch=0, cursor=0):
+        if blocksize > batchsize:
+            raise ValueError("The blocksize (%d) can't be more than the batchsize (%d)." % (blocksize, batchsize))
+        self.population = population
+        self.batchsize = batchsize
+        self.blocksize = blocksize
+        self.starts = n.arange(0, len(population), blocksize)
+        self.costs = n.add.reduceat(lengths, self.starts)
+        self.per_batch = batchsize // blocksize
+        self.stratify = stratify
+        self.seed = seed
+        self.epoch = epoch
+        self.cursor = cursor
+        self.plan()
+
+    def plan(self):
+        # self.order is the epoch's rows of population, block by block
+        rng = n.random.RandomState([self.seed, self.epoch])
+        nblocks = len(self.starts)
+        if self.stratify:
+            # -1 pads the last band
+            nbatches = -(-nblocks // self.per_batch)
+            padding = -n.ones(nbatches * self.per_batch - nblocks, dtype=int)
+            bands = n.concatenate((n.argsort(self.costs, kind='mergesort'), padding))
+            bands = bands.reshape(self.per_batch, nbatches)
+            for band in bands:
+                rng.shuffle(band)
+            blocks = bands.T.ravel()
+            blocks = blocks[blocks >= 0]
+        else:
+            blocks = rng.permutation(nblocks)
+        rows = (self.starts[blocks][:, n.newaxis] + n.arange(self.blocksize)).ravel()
+        self.order = rows[rows < len(self.population)]
+        self.nbatches = -(-len(self.order) // self.batchsize)
+
+    def next(self):
+        if self.cursor >= self.nbatches:
+            self.epoch += 1
+            self.cursor = 0
+            self.plan()
+            logging.info("Starting epoch %d." % self.epoch)
+        rows = n.sort(self.order[self.cursor * self.batchsize:(self.cursor + 1) * self.batchsize])
+        self.cursor += 1
+        return self.population[rows]
+
+    def state(self):
+        return [self.seed, self.epoch, self.cursor]
+
+
+def shared_array(a):
+    """
+    Copies a float array into memory that forked worker processes share
+    with us, so in place updates are seen on both sides.
+    """
+    shared = n.frombuffer(RawArray('d', a.size), dtype=n.float64).reshape(a.shape)
+    shared[:] = a
+    return shared
+
+# what the E-step workers inherit when they're forked
+_worker_state = {}
+
+def ignore_interrupts():
+    # leave ^C, and the SIGTERM a batch scheduler sends the whole process
+    # group, to the master process, which stops at the end of the iteration
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def e_step_worker(task):
+    docset_ids, worker_seed, start = task
+    n.random.seed(worker_seed)
+    corpus = _worker_state['corpus']
+    timer = phasetimer(PHASES)
+    with timer("estep"):
+        docset = minibatch(corpus, docset_ids)
+        result = _worker_state['model'].do_e_step(docset, timer, start)
+    return result[0], result[1], result[2:], (timer.current_wall, timer.current_cpu)
+
+class workerpool:
+    """
+    Runs a model's E-step over the shards of a mini-batch in separate
+    processes. The workers are forked with the model and corpus, and read
+    the model's expectations from shared memory, so only document ids,
+    gammas and the sufficient statistics for the columns each shard's
+    documents use are sent back and forth.
+    """
+
+    def __init__(self, model, corpus, workers):
+        self.workers = workers
+        _worker_state.update(model=model, corpus=corpus)
+        self.pool = multiprocessing.Pool(workers, ignore_interrupts)
+
+    def e_step(self, docset_ids, timer=None, start=None):
+        # dealing the documents out in turn gives every shard about the
+        # same mix of long and short documents, and keeps them in order.
+        docset_ids = n.asarray(docset_ids)
+        nshards = min(self.workers, len(docset_ids))
+        shards = [docset_ids[i::nshards] for i in xrange(nshards)]
+        # every shard gets its own stream, drawn from ours so runs repeat
+        seeds = n.random.randint(2**31, size=len(shards))
+        starts = [None] * len(shards)
+        if start is not None:
+            starts = [start[i::nshards] for i in xrange(nshards)]
+        results = self.pool.map_async(e_step_worker, zip(shards, seeds, starts)).get(WORKER_TIMEOUT)
+        gamma = n.empty((len(docset_ids), results[0][0].shape[1]))
+        iterations = n.empty(len(docset_ids), dtype=int)
+        for i, (shardgamma, sharditerations, shardstats, timings) in enumerate(results):
+            gamma[i::nshards] = shardgamma
+            iterations[i::nshards] = sharditerations
+        if timer:
+            # the shards ran side by side: their CPU time adds up, but
+            # only the slowest one's wall time counts.
+            walls, cpus = zip(*[timings for shardgamma, sharditerations, shardstats, timings in results])
+            e, s = PHASES.index("estep"), PHASES.index("scatter")
+            timer.add("estep", 0, sum(cpu[e] for cpu in cpus))
+            timer.add("scatter", max(wall[s] for wall in walls), sum(cpu[s] for cpu in cpus))
+        stats = []
+        for m in xrange(len(results[0][2])):
+            blocks = [shardstats[m] for shardgamma, sharditerations, shardstats, timings in results]
+            cols = n.unique(n.concatenate([shardcols for shardcols, block in blocks]))
+            total = n.zeros((blocks[0][1].shape[0], len(cols)))
+            for shardcols, block in blocks:
+                total[:, n.searchsorted(cols, shardcols)] += block
+            stats.append((cols, total))
+        return tuple([gamma, iterations] + stats)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def table_key(m):
+    # how a modality's topics are saved: phi for the words, then psi, psi2, ...
+    return m == 0 and "phi" or "psi%s" % (m > 1 and m or "")
+
+def prior_key(m):
+    # ... and their priors: eta for the words, then mu, mu2, ...
+    return m == 0 and "eta" or "mu%s" % (m > 1 and m or "")
 
 
 class OnlineLDA:
     """
     Implements online VB for LDA as described in (Hoffman et al. 2010).
+
+    Every token is a word and any number of features, one id per modality.
+    Each modality has its own K x V_m topics, so a model takes only the
+    space of the modalities it has.
     """
 
-    def __init__(self, input_filename, vocab, feats, K, D, alpha, eta, mu, tau0, kappa):
+    def __init__(self, input_filename, vocabs, K, D, alpha, priors, tau0, kappa):
         """
         Arguments:
         K: Number of topics
-        vocab: A set of words to recognize. When analyzing documents, any word
-           not in this set will be ignored.
+        vocabs: For each modality (the words, then the features), a set of
+           ids to recognize. When analyzing documents, any id not in this set
+           will be ignored.
         D: Total number of documents in the population. For a fixed corpus,
            this is the size of the corpus. In the truly online setting, this
            can be an estimate of the maximum number of documents that
            could ever be seen.
         alpha: Hyperparameter for prior on weight vectors theta
-        eta: Hyperparameter for prior on topics beta
+        priors: For each modality, the hyperparameter for the prior on its
+           topics (eta for the words' beta, mu for the features' pi, ...)
         tau0: A (positive) learning parameter that downweights early iterations
         kappa: Learning rate: exponential decay rate---should be between
              (0.5, 1.0] to guarantee asymptotic convergence.
@@ -100,141 +538,108 @@ class OnlineLDA:
         """
         self.input_filename = input_filename
 
-        self._vocab = vocab
-        self._feats = feats
-        self._W = max(vocab) + 1
-        self._F = max(feats) + 1
+        self._vocabs = vocabs
 
         self._K = K
         self._D = D
 
         self._alpha = alpha
-        self._eta = eta
-        self._mu = mu
+        self._priors = list(priors)
         self._tau0 = tau0 + 1
         self._kappa = kappa
         self._updatect = 0
         self._rhot = 1.0
 
-        # Initialize the variational distribution q(beta|lambda)
-        self._lambda = 1*n.random.gamma(100., 1./100., (self._K, self._W))
-        self._Elogbeta = dirichlet_expectation_2(self._lambda)
-        self._expElogbeta = n.exp(self._Elogbeta)
-
-        # ... and var distr q(pi|omega)
-        self._omega = 1 * n.random.gamma(100., 1./100., (self._K, self._F))
-        self._Elogpi = dirichlet_expectation_2(self._omega)
-        self._expElogpi = n.exp(self._Elogpi)
+        # Initialize the variational distributions q(beta|lambda), q(pi|omega), ...
+        self._tables = [lazydirichlet(1*n.random.gamma(100., 1./100., (self._K, max(vocab) + 1)))
+                        for vocab in vocabs]
 
         # bookkeeping stuff
+        # a row per iteration: its seconds, the E step's seconds, and the
+        # number of tokens (document rows) in the mini-batch
         self.timediffs = []
         self.perwordbounds = []
         self.max_iteration = 0
         self.times_doc_seen = n.zeros(D)
-
-    def do_e_step(self, docs):
+        self.heldout_ids = n.zeros(0, dtype=int)
+        # an epochscheduler's state, if we're using one
+        self.schedule = []
+        self.checkpointer = checkpointer()
+        self.workers = None
+        self.timer = phasetimer(PHASES)
+        # a row per iteration: the mean and most E step iterations a
+        # document took
+        self.estep_iterations = []
+        # where the E step starts documents we've seen before, if anywhere
+        self.gammas = None
+
+    def do_e_step(self, docs, timer=None, start=None):
         """
         Given a mini-batch of documents, estimates the parameters
         gamma controlling the variational distribution over the topic
         weights for each document in the mini-batch.
 
         Arguments:
-        docs:  List of D documents. Each document must be represented
-               as a string. (Word order is unimportant.) Any
-               words not in the vocabulary will be ignored.
-
-        Returns a tuple containing the estimated values of gamma,
-        as well as sufficient statistics needed to update lambda.
+        docs:  A mini-batch of documents, as returned by minibatch().
+        timer: A phasetimer to time the scatter with, if any.
+        start: The documents' starting gammas, if any, see fold_in.
+
+        Returns a tuple containing the estimated values of gamma, how
+        many iterations each document took, as well as sufficient
+        statistics needed to update lambda, as the (cols, stats) pairs of
+        sufficient_stats, one per modality.
         """
-        # This is to handle the case where someone just hands us a single
-        # document, not in a list.
-        (wordcts, wordids, featids) = parse_doc_list(docs)
-        batchD = len(wordids)
-
-        # Initialize the variational distribution q(theta|gamma) for
-        # the mini-batch
-        gamma = 1 * n.random.gamma(100., 1./100., (batchD, self._K))
-        Elogtheta = dirichlet_expectation_2(gamma)
-        expElogtheta = n.exp(Elogtheta)
-
-        # book keeping for updating lambda later.
-        wstats = n.zeros(self._lambda.shape)
-        # and updating pi later
-        fstats = n.zeros(self._omega.shape)
-
-        # Now, for each document d update that document's gamma and phi
-        for d in xrange(batchD):
-            # These are mostly just shorthand (but might help cache locality)
-            wids = wordids[d]
-            fids = featids[d]
-            cts = wordcts[d]
-
-            # k sized vectors, distr of topics over doc
-            gammad = gamma[d]
-            Elogthetad = Elogtheta[d]
-            expElogthetad = expElogtheta[d]
-
-            Elogbetad = n.take(self._Elogbeta, wids, axis=1)
-            #expElogbetad = n.take(self._expElogbeta, wids, axis=1)
-            Elogpid = n.take(self._Elogpi, fids, axis=1)
-            #expElogpid = n.take(self._expElogpi, fids, axis=1)
-            likelihoods = n.exp(Elogbetad + Elogpid)
-
-            # The optimal phi_{dwk} is proportional to
-            #    expElogthetad_k * expElogbetad_w * expElogpid_f = exp { Elogthetad_k + Elogbetad_w  + Elogpid_f }
-            # phinorm is the normalizer.
-            phinorm = n.dot(expElogthetad, likelihoods) + 1e-100
-
-            # Iterate between gamma and phi until convergence
-            for it in range(0, 100):
-                # keep track of convergence
-                lastgamma = gammad
-
-                # We represent phi implicitly to save memory and time.
-                # Substituting the value of the optimal phi back into
-                # the update for gamma gives this update. Cf. Lee&Seung 2001.
-                gammad = self._alpha + expElogthetad * n.dot(cts / phinorm, likelihoods.T)
-                Elogthetad = dirichlet_expectation_1(gammad)
-                expElogthetad = n.exp(Elogthetad)
-                phinorm = n.dot(expElogthetad, likelihoods) + 1e-100
-
-                # If gamma hasn't changed much, we're done.
-                meanchange = n.sum(n.abs(gammad - lastgamma))
-                if (meanchange < self._K * MEAN_CHANGE_THRESH):
-                    break
-
-            # update our global copy of gamma
-            gamma[d] = gammad
-
-            # Contribution of document d to the expected sufficient
-            # statistics for the M step.
-            uniq_wids, w_cts = remove_redundancies(wids, cts)
-            uniq_fids, f_cts = remove_redundancies(fids, cts)
-            update_stats_wids = n.outer(expElogthetad.T, w_cts / n.dot(expElogthetad, n.take(self._expElogbeta, uniq_wids, axis=1)))
-            update_stats_fids = n.outer(expElogthetad.T, f_cts / n.dot(expElogthetad, n.take(self._expElogpi, uniq_fids, axis=1)))
-
-            wstats[:,uniq_wids] += update_stats_wids
-            fstats[:,uniq_fids] += update_stats_fids
-
-        # This step finishes computing the sufficient statistics for the
-        # M step, so that
+        (lengths, cts) = docs[:2]
+        batchD = len(lengths)
+
+        (gamma, expElogtheta, iterations) = fold_in(docs, [table.Elog for table in self._tables], self._K, self._alpha,
+                                                    start)
+        timer = timer or phasetimer(PHASES)
+
+        # Contribution of the documents to the expected sufficient
+        # statistics for the M step, scattered for the whole mini-batch,
+        # so that
         # wstats[k, w] = \sum_d n_{dw} * phi_{dwk}
         # = \sum_d n_{dw} * exp{Elogtheta_{dk} + Elogbeta_{kw}} / phinorm_{dw}.
-        wstats = wstats * self._expElogbeta
-        fstats = fstats * self._expElogpi
+        with timer("scatter"):
+            tokendocs = n.repeat(n.arange(batchD), lengths)
+            cts = cts.astype(float)
+            stats = [sufficient_stats(tokendocs, ids, cts, expElogtheta, table.expElog)
+                     for table, ids in zip(self._tables, docs[2:])]
 
-        return (gamma, wstats, fstats)
+        return tuple([gamma, iterations] + stats)
 
-    def update_lambda(self, docs):
+    def start_workers(self, corpus, workers):
+        """
+        Forks a pool of processes to share the E-step. From now on the
+        expectations live in shared memory and are only updated in place.
+        """
+        for table in self._tables:
+            table.share()
+        self.workers = workerpool(self, corpus, workers)
+
+    def stop_workers(self):
+        if self.workers:
+            self.workers.close()
+            self.workers = None
+
+    def expect(self, docs):
+        # Catch up on the expectations of the words and features we're
+        # about to use.
+        for table, ids in zip(self._tables, docs[2:]):
+            table.expect(ids)
+
+    def update_lambda(self, docs, docset_ids=None, estimate_bound=True):
         """
         First does an E step on the mini-batch given in wordids and
         wordcts, then uses the result of that E step to update the
         variational parameter matrix lambda.
 
         Arguments:
-        docs:  List of D documents. Each document must be represented
-               as a string. (Word order is unimportant.) Any
-               words not in the vocabulary will be ignored.
+        docs:  A mini-batch of documents, as returned by minibatch().
+        docset_ids: The documents' rows in the corpus. Needed to split
+               the E step between the workers, if there are any.
+        estimate_bound: Whether to estimate the bound (see below) at all.
 
         Returns gamma, the parameters to the variational distribution
         over the topic weights theta for the documents analyzed in this
@@ -242,48 +647,67 @@ class OnlineLDA:
 
         Also returns an estimate of the variational bound for the
         entire corpus for the OLD setting of lambda based on the
-        documents passed in. This can be used as a (possibly very
-        noisy) estimate of held-out likelihood.
+        documents passed in, or None if we were asked not to. This can
+        be used as a (possibly very noisy) estimate of held-out
+        likelihood.
         """
 
         # rhot will be between 0 and 1, and says how much to weight
         # the information we got from this mini-batch.
         rhot = pow(self._tau0 + self._updatect, -self._kappa)
         self._rhot = rhot
+        with self.timer("expect"):
+            self.expect(docs)
         # Do an E step to update gamma, phi | lambda for this
         # mini-batch. This also returns the information about phi that
         # we need to update lambda.
-        (gamma, wstats, fstats) = self.do_e_step(docs)
+        tic = time.time()
+        start = None
+        if self.gammas and docset_ids is not None:
+            start = self.gammas.lookup(docset_ids)
+        with self.timer("estep"):
+            if self.workers and docset_ids is not None:
+                result = self.workers.e_step(docset_ids, self.timer, start)
+            else:
+                result = self.do_e_step(docs, self.timer, start)
+        (gamma, self.inner_iterations) = result[:2]
+        if start is not None:
+            self.gammas.store(docset_ids, gamma)
+            self.warm_starts = n.sum(~n.isnan(start[:, 0]))
+        self.estep_seconds = time.time() - tic
         # Estimate held-out likelihood for current values of lambda.
-        bound = self.approx_bound(docs, gamma)
+        bound = None
+        if estimate_bound:
+            with self.timer("bound"):
+                bound = self.approx_bound(docs, gamma)
 
-        # Update lambda based on documents.
-        self._lambda = self._lambda * (1-rhot) + rhot * (self._eta + self._D * wstats / len(docs[0]))
-        # hardcode equal probability for each of the zero words. technically this isn't necessary.
-        if self._W > 1:
-            self._lambda[:,0] = self._lambda[:,1:].mean()
-        else:
-            self._lambda[:,0] = self._lambda.mean()
-        # update expectations
-        self._Elogbeta = dirichlet_expectation_2(self._lambda)
-        self._expElogbeta = n.exp(self._Elogbeta)
-
-        # update pi based on documents
-        self._omega = self._omega * (1 - rhot) + rhot * (self._mu + self._D * fstats / len(docs[0]))
-        # hardcode equal probability for each the features
-        if self._F > 1:
-            self._omega[:,0] = self._omega[:,1:].mean()
-        else:
-            self._omega[:,0] = self._omega.mean()
-        # update expectations
-        self._Elogpi = dirichlet_expectation_2(self._omega)
-        self._expElogpi = n.exp(self._Elogpi)
+        # Update lambda, omega, ... based on documents. Only the columns
+        # the documents used change, besides the decay.
+        with self.timer("mstep"):
+            for table, prior, (cols, stats) in zip(self._tables, self._priors, result[2:]):
+                table.update(rhot, prior, cols, self._D * stats / len(docs[0]))
 
         # mark that we completed this iteration
         self._updatect += 1
 
         return gamma, bound
 
+    def heldout_bound(self, docs, docset_ids):
+        """
+        Estimates the variational bound like approx_bound, but on documents
+        we don't train on, under the current lambda. The E step here always
+        starts from the same random gammas, and leaves the random state as
+        it found it, so checking the bound doesn't change the training run.
+        """
+        self.expect(docs)
+        state = n.random.get_state()
+        if self.workers:
+            gamma = self.workers.e_step(docset_ids)[0]
+        else:
+            gamma = self.do_e_step(docs)[0]
+        n.random.set_state(state)
+        return self.approx_bound(docs, gamma)
+
     def approx_bound(self, docs, gamma):
         """
         Estimates the variational bound over *all documents* using only
@@ -294,25 +718,20 @@ class OnlineLDA:
         The output of this function is going to be noisy, but can be
         useful for assessing convergence.
         """
-        (wordcts, wordids, featids) = parse_doc_list(docs)
-        batchD = len(wordids)
+        (lengths, wordcts) = docs[:2]
+        batchD = len(lengths)
 
         score = 0
         Elogtheta = dirichlet_expectation_2(gamma)
-        expElogtheta = n.exp(Elogtheta)
-
-        # E[log p(docs | theta, beta, pi)]
-        for d in xrange(batchD):
-            gammad = gamma[d]
-            wids = wordids[d]
-            fids = featids[d]
-            cts = n.array(wordcts[d])
-            right = n.take(self._Elogbeta, wids, axis=1).T
-            right2 = n.take(self._Elogpi, fids, axis=1).T
-            temp = Elogtheta[d] + (right + right2)[:,:]
-            tmax_v = n.max(temp, axis=1)
-            phinorm = n.log(n.sum(n.exp(temp[:,:].T - tmax_v), axis=0)) + tmax_v
-            score += n.dot(cts, phinorm)
+
+        # E[log p(docs | theta, beta, pi, ...)], all the tokens at once
+        tokendocs = n.repeat(n.arange(batchD), lengths)
+        temp = Elogtheta[tokendocs]
+        for table, ids in zip(self._tables, docs[2:]):
+            temp += table.Elog.T[ids]
+        tmax_v = n.max(temp, axis=1)
+        phinorm = n.log(n.sum(n.exp(temp.T - tmax_v), axis=0)) + tmax_v
+        score += n.dot(wordcts, phinorm)
 
         # E[log p(theta | alpha) - log q(theta | gamma)]
         score += n.sum((self._alpha - gamma)*Elogtheta)
@@ -322,95 +741,181 @@ class OnlineLDA:
         # Compensate for the subsampling of the population of documents
         score = score * self._D / batchD
 
-        # E[log p(beta | eta) - log q (beta | lambda)]
-        score += n.sum((self._eta-self._lambda)*self._Elogbeta)
-        score += n.sum(gammaln(self._lambda) - gammaln(self._eta))
-        score += n.sum(gammaln(self._eta*self._W) -
-                       gammaln(n.sum(self._lambda, 1)))
-
-        # E[log p(pi | mu) - log q (pi | omega)]
-        score += n.sum((self._mu-self._omega)*self._Elogpi)
-        score += n.sum(gammaln(self._omega) - gammaln(self._mu))
-        score += n.sum(gammaln(self._mu*self._F) -
-                       gammaln(n.sum(self._omega, 1)))
+        # E[log p(beta | eta) - log q (beta | lambda)], and likewise for
+        # pi | mu and the rest
+        for table, prior in zip(self._tables, self._priors):
+            score += table.prior_term(prior)
         return score
 
-    def save_model(self, filename):
-        n.savez_compressed(filename + ".tmp.npz",
-                phi=self._lambda,
-                psi=self._omega,
+    def save_model(self, filename, background=False):
+        modified_filename = filename.endswith(".npz") and filename[:-4] or filename
+        versioned_filename = "%s.%d.npz" % (modified_filename, self._updatect)
+
+        def finish():
+            os.rename(filename + ".tmp.npz", versioned_filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.symlink(os.path.abspath(versioned_filename), filename)
+
+        # saving leaves the model as it was, so a continued run goes on
+        # exactly as if it had never stopped
+        tables = rng_state()
+        for m, (table, prior) in enumerate(zip(self._tables, self._priors)):
+            tables.update(table.arrays(table_key(m)))
+            tables[prior_key(m)] = prior
+        if self.gammas:
+            tables.update(self.gammas.arrays())
+        self.checkpointer.save(filename + ".tmp.npz", finish, background=background,
                 max_iteration=self._updatect,
                 k=self._K,
                 timediffs=self.timediffs,
                 perwordbounds=self.perwordbounds,
-                eta = self._eta,
-                mu = self._mu,
                 tau0 = self._tau0,
+                kappa = self._kappa,
                 alpha = self._alpha,
                 times_doc_seen = self.times_doc_seen,
+                heldout_ids = self.heldout_ids,
+                schedule = n.array(self.schedule, dtype=n.int64),
                 input_filename = self.input_filename,
+                estep_iterations = n.reshape(self.estep_iterations, (-1, 2)),
+                **dict(tables, **self.timer.arrays())
                 )
-        modified_filename = filename.endswith(".npz") and filename[:-4] or filename
-        versioned_filename = "%s.%d.npz" % (modified_filename, self._updatect)
-        os.rename(filename + ".tmp.npz", versioned_filename)
-        if os.path.exists(filename):
-            os.remove(filename)
-        os.symlink(os.path.abspath(versioned_filename), filename)
 
     def load_model(self, filename):
         m = n.load(filename)
-        self._lambda = m['phi']
-        self._omega = m['psi']
+        modalities = 1
+        while table_key(modalities) in m.files:
+            modalities += 1
+        if modalities != len(self._tables):
+            raise ValueError("%s has %d modalities, but the corpus has %d." % (filename, modalities, len(self._tables)))
+        self._tables = [lazydirichlet(m[table_key(i)]) for i in xrange(modalities)]
+        for i, table in enumerate(self._tables):
+            table.load(m, table_key(i))
+        self._priors = [m[prior_key(i)] for i in xrange(modalities)]
         self._K = m['k']
         self._updatect = m['max_iteration']
-        self._eta = m['eta']
-        self._mu = m['mu']
         self._tau0 = m['tau0']
+        if 'kappa' in m.files:
+            self._kappa = float(m['kappa'])
         self._alpha = m['alpha']
-        self.timediffs = list(m['timediffs'])
+        timediffs = m['timediffs']
+        if timediffs.ndim == 1:
+            # older models only kept each iteration's seconds
+            timediffs = [(seconds, n.nan, n.nan) for seconds in timediffs]
+        self.timediffs = [tuple(row) for row in timediffs]
         self.perwordbounds = list(m['perwordbounds'])
         self.times_doc_seen = m['times_doc_seen']
+        if 'heldout_ids' in m.files:
+            self.heldout_ids = m['heldout_ids']
+        if 'schedule' in m.files:
+            self.schedule = list(m['schedule'])
+        self.timer.load(m)
+        if 'estep_iterations' in m.files:
+            self.estep_iterations = [tuple(row) for row in m['estep_iterations']]
         self.input_filename = str(m['input_filename'])
+        if 'warm_gammas' in m.files:
+            self.gammas = gammacache(self._D, len(m['warm_gammas']), self._K, m['warm_gammas'].dtype)
+            self.gammas.load(m)
+        set_rng_state(m)
+
+    def inference(self, corpus, batchsize, max_iterations, model_file, workers=1, bound_every=1, heldout=0,
+                  schedule="random", blocksize=16, warm_start=0, warm_dtype="float16"):
+        """
+        Trains on mini-batches of batchsize documents from corpus. Every
+        bound_every iterations (never if 0) we log an estimate of the
+        per-word bound: on that iteration's mini-batch, or, if heldout > 0,
+        on a fixed sample of that many documents set aside from training.
 
-        # reinitialize the variational distribution q(beta|lambda)
-        self._Elogbeta = dirichlet_expectation_2(self._lambda)
-        self._expElogbeta = n.exp(self._Elogbeta)
-        # and q(pi|omega)
-        self._Elogpi = dirichlet_expectation_2(self._omega)
-        self._expElogpi = n.exp(self._Elogpi)
+        The "random" schedule samples every mini-batch independently; "epoch"
+        and "stratified" go through the documents an epoch at a time in
+        blocks of blocksize, see epochscheduler.
 
-    def inference(self, corpus, batchsize, max_iterations, model_file):
+        With warm_start > 0, the E step starts the last warm_start documents
+        we saw from their previous gamma, see gammacache.
+        """
         D = self._D
-        batchsize = min(batchsize, D)
+        if schedule != "random" and blocksize > batchsize:
+            raise ValueError("The blocksize (%d) can't be more than the batchsize (%d)." % (blocksize, batchsize))
+        if not warm_start:
+            self.gammas = None
+        elif not self.gammas or self.gammas.gammas.shape != (min(warm_start, D), self._K) or \
+                self.gammas.gammas.dtype != n.dtype(warm_dtype):
+            # a continued run keeps the gammas it saved
+            self.gammas = gammacache(D, warm_start, self._K, n.dtype(warm_dtype))
+        if heldout and len(self.heldout_ids) != heldout:
+            self.heldout_ids = n.array(sorted(sample(xrange(D), heldout)))
+        if len(self.heldout_ids):
+            population = n.setdiff1d(n.arange(D), self.heldout_ids)
+            heldout_docs = minibatch(corpus, self.heldout_ids)
+        else:
+            population = n.arange(D)
+        batchsize = min(batchsize, len(population))
+        scheduler = None
+        if schedule != "random":
+            if len(self.schedule) != 3:
+                self.schedule = [n.random.randint(2**31), 0, 0]
+            seed, epoch, cursor = self.schedule
+            offsets = corpus[0]
+            # (the batchsize only drops below the blocksize if every document fits in one batch)
+            scheduler = epochscheduler(population, offsets[population + 1] - offsets[population], batchsize,
+                                       min(blocksize, batchsize), schedule == "stratified", seed, epoch, cursor)
+        if workers > 1:
+            logging.info("Starting %d E-step workers." % workers)
+            self.start_workers(corpus, workers)
         # keep track of docs seen
         bigtic = datetime.datetime.now()
         shouldsave = True
         try:
             save_tic = datetime.datetime.now()
-            for iteration in xrange(self._updatect + 1, max_iterations + 1):
-                tic = datetime.datetime.now()
-                docset_ids = sample(xrange(D), batchsize)
-                docset = (corpus[0][docset_ids], corpus[1][docset_ids], corpus[2][docset_ids])
-                (gamma, bound) = self.update_lambda(docset)
-                (wordcts, wordids, featids) = parse_doc_list(docset)
-                perwordbound = bound * len(docset_ids) / (D * sum(n.sum(doc) for doc in wordcts))
-                if n.isnan(perwordbound):
-                    logging.error("perwordbound is nan. Cleaning up without saving.")
-                    shouldsave = False
-                    break
-                toc = datetime.datetime.now()
-                self.times_doc_seen[docset_ids] += 1
-                logging.info('(%4d) %4d [%15s/%15s]:  rho_t = %1.5f,  perwordbound = (%8f) [seen = %d/%d]' %
-                    (self._K, iteration, toc - tic, toc - bigtic, self._rhot, perwordbound, n.sum(self.times_doc_seen > 0), D))
-                self.perwordbounds.append(perwordbound)
-                self.timediffs.append((toc - tic).total_seconds())
-                if toc - save_tic >= SAVE_FREQUENCY:
-                    logging.info("Processed for %s > %s. Saving model to %s..." % (toc - save_tic, SAVE_FREQUENCY, model_file))
-                    save_tic = toc
-                    self.save_model(model_file)
+            stop = stopsignal()
+            with stop:
+                for iteration in xrange(self._updatect + 1, max_iterations + 1):
+                    tic = datetime.datetime.now()
+                    with self.timer("minibatch"):
+                        if scheduler:
+                            docset_ids = scheduler.next()
+                            self.schedule = scheduler.state()
+                        else:
+                            docset_ids = sample(population, batchsize)
+                        docset = minibatch(corpus, docset_ids)
+                    tokens = n.sum(docset[0])
+                    evaluate = bound_every and iteration % bound_every == 0
+                    (gamma, bound) = self.update_lambda(docset, docset_ids, evaluate and not heldout)
+                    if evaluate and heldout:
+                        docset = heldout_docs
+                        with self.timer("bound"):
+                            bound = self.heldout_bound(heldout_docs, self.heldout_ids)
+                    if bound is None:
+                        perwordbound = n.nan
+                    else:
+                        (lengths, wordcts) = docset[:2]
+                        perwordbound = bound * len(lengths) / (D * float(n.sum(wordcts)))
+                        if n.isnan(perwordbound):
+                            logging.error("perwordbound is nan. Cleaning up without saving.")
+                            shouldsave = False
+                            break
+                    toc = datetime.datetime.now()
+                    self.times_doc_seen[docset_ids] += 1
+                    logging.info('(%4d) %4d [%15s/%15s]:  rho_t = %1.5f,  perwordbound = (%8f) [seen = %d/%d] [inner = %.1f%s]' %
+                        (self._K, iteration, toc - tic, toc - bigtic, self._rhot, perwordbound, n.sum(self.times_doc_seen > 0), D,
+                         n.mean(self.inner_iterations), self.gammas and ", warm = %d/%d" % (self.warm_starts, len(docset_ids)) or ""))
+                    self.perwordbounds.append(perwordbound)
+                    self.timediffs.append(((toc - tic).total_seconds(), self.estep_seconds, tokens))
+                    self.estep_iterations.append((n.mean(self.inner_iterations), n.max(self.inner_iterations)))
+                    if toc - save_tic >= SAVE_FREQUENCY:
+                        logging.info("Processed for %s > %s. Saving model to %s..." % (toc - save_tic, SAVE_FREQUENCY, model_file))
+                        save_tic = toc
+                        with self.timer("save"):
+                            self.save_model(model_file, background=True)
+                    self.timer.lap()
+                    if stop.requested:
+                        logging.info("Stopping at iteration %d." % iteration)
+                        break
         except KeyboardInterrupt:
             logging.info("Terminated early...")
             pass
+        finally:
+            self.stop_workers()
 
         bigtoc = datetime.datetime.now()
         logging.info("Total learning runtime: %s" % (bigtoc - bigtic))
@@ -423,47 +928,25 @@ class OnlineLDA:
 
 
 # Reads in the corpus
-def read_andrews(filename):
+def read_andrews(filename, dims=None):
+    """
+    Reads the corpus as CSR (offsets, data) through aesir's binary cache:
+    the tokens of document d are data[:, offsets[d]:offsets[d+1]], with the
+    word ids, the ids of each feature modality and the counts as its rows.
+    Unless we're told how many modalities there are, there are as many as
+    the corpus's widest item has, and at least the words and one feature.
+    """
     tic = datetime.datetime.now()
     logging.info("reading corpus...")
-    wordids = []
-    featids = []
-    wordcts = []
-    with open(filename) as f:
-        for d_s in f.readlines():
-            dids = []
-            fids = []
-            dcts = []
-            for w in d_s.strip().split():
-                colon = w.rindex(":")
-                i, c = w[:colon], int(w[colon+1:])
-                if "," in i:
-                    # TODO: we'll need to change this if we go to higher dimensional
-                    i, f = i.split(",")
-                    i = int(i)
-                    f = int(f)
-                else:
-                    i = int(i)
-                    f = 0
-
-                dids.append(i)
-                dcts.append(c)
-                fids.append(f)
-
-            wordcts.append(n.array(dcts))
-            wordids.append(n.array(dids))
-            featids.append(n.array(fids))
-
-    featids = n.array(featids)
-    wordids = n.array(wordids)
-    wordcts = n.array(wordcts)
-
+    if not dims:
+        dims = max(2, datadims(filename))
+        logging.info("Found %d modalities." % dims)
+    corpus = dataread(filename, dims)
     toc = datetime.datetime.now()
     logging.info("Finished reading corpus. (took %s)" % (toc - tic))
+    return corpus
 
-    return (wordcts, wordids, featids)
-
-def main():
+def main(dims=None):
     parser = argparse.ArgumentParser(
                 description='Variational inference for Andrews model.')
     parser.add_argument('--input', '-i', metavar='FILE',
@@ -485,10 +968,30 @@ def main():
                         help='Hyperparamater eta. (Default 1/V)')
     parser.add_argument('--alpha', metavar='FLOAT', type=float,
                         help='Hyperparameter alpha. (Default 1/k)')
-    parser.add_argument('--mu', metavar='FLOAT', type=float,
-                        help='Hyperparameter mu. (Default 1/F)')
+    parser.add_argument('--mu', metavar='FLOAT', type=float, nargs='+', default=[],
+                        help='Hyperparameter mu, for each feature modality in turn. (Default 1/F)')
+    parser.add_argument('--mu2', metavar='FLOAT', type=float,
+                        help='Hyperparameter mu of the second feature modality. (Default 1/F2)')
+    parser.add_argument('--dims', '-d', metavar='INT', type=int, default=dims,
+                        help='The number of modalities: the words, and every feature. (Default from the corpus)')
     parser.add_argument('--randomseed', metavar='INT', type=int,
                         help='Supply the seed for the random number generator.')
+    parser.add_argument('--workers', '-w', metavar='INT', type=int, default=1,
+                        help='Split the E step between this many processes.')
+    parser.add_argument('--bound-every', metavar='INT', type=int, default=1,
+                        help='Estimate the per-word bound every this many iterations. (0 for never)')
+    parser.add_argument('--heldout', metavar='INT', type=int, default=0,
+                        help='Estimate the bound on this many documents held out of training, '
+                             'instead of on the mini-batch.')
+    parser.add_argument('--schedule', choices=SCHEDULES, default='random',
+                        help='How to pick mini-batches: independently at random, or a shuffled epoch at a time, '
+                             'optionally with every mini-batch stratified by document length.')
+    parser.add_argument('--blocksize', metavar='INT', type=int, default=16,
+                        help='For epoch schedules, how many neighbouring documents to read together.')
+    parser.add_argument('--warm-start', metavar='INT', type=int, default=0,
+                        help="Start the E step from the gammas of up to this many documents we've seen before.")
+    parser.add_argument('--warm-dtype', choices=WARM_DTYPES, default='float16',
+                        help='How precisely to keep the gammas for warm starts.')
     args = parser.parse_args()
 
     if args.randomseed:
@@ -497,23 +1000,27 @@ def main():
 
     logging.info("Online Variational Bayes inference.")
     logging.info("Calling read_andrews")
-    corpus = read_andrews(args.input)
+    corpus = read_andrews(args.input, args.dims)
 
-    D = len(corpus[0])
-    vocab = range(max(wid for doc in corpus[1] for wid in doc)+1)
-    feats = range(max(fid for doc in corpus[2] for fid in doc)+1)
+    offsets, data = corpus
+    D = len(offsets) - 1
+    # the words, then each feature modality
+    vocabs = [range(ids.max()+1) for ids in data[:-1]]
 
     k = args.topics
     batchsize = args.batchsize
     tau0 = args.tau0
     kappa = args.kappa
     numiterations = args.iterations
-    eta = args.eta and args.eta or 1./len(vocab)
-    mu = args.mu and args.mu or 1./len(feats)
+    # any prior we're not given is 1 over the size of its vocabulary
+    given = [args.eta] + args.mu + [None] * len(vocabs)
+    if args.mu2:
+        given[2] = args.mu2
+    priors = [given[m] or 1./len(vocab) for m, vocab in enumerate(vocabs)]
     alpha = args.alpha and args.alpha or 1./k
 
     logging.info("Initializing OnlineLDA object.")
-    olda = OnlineLDA(args.input, vocab, feats, k, D, alpha, eta, mu, tau0, kappa)
+    olda = OnlineLDA(args.input, vocabs, k, D, alpha, priors, tau0, kappa)
     if args.kontinue:
         logging.info("Attemping to resume from %s." % args.output)
         try:
@@ -522,7 +1029,8 @@ def main():
             logging.warning("IOError when loading old model. Starting from the beginning.")
 
     logging.info("Starting inference.")
-    olda.inference(corpus, batchsize, numiterations, args.output)
+    olda.inference(corpus, batchsize, numiterations, args.output, args.workers, args.bound_every, args.heldout,
+                   args.schedule, args.blocksize, args.warm_start, args.warm_dtype)
     logging.info("Finished with inference.")
 
 if __name__ == '__main__':
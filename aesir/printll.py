@@ -6,32 +6,83 @@ import os.path
 from itertools import izip
 
 HUMAN=False
+# with --phases, tabulate where each model's iterations spent their time
+# (see aesir.phasetimer) instead of the bounds
+PHASES = "--phases" in sys.argv
+
+def print_phases(f, m):
+    if "phase_wall" not in m:
+        print "%s has no timings, skipping" % f
+        return
+    phases = list(m["phases"])
+    # mean seconds per iteration, and the share of an iteration's wall time
+    wall = m["phase_wall"].mean(axis=0)
+    cpu = m["phase_cpu"].mean(axis=0)
+    timediffs = m["timediffs"]
+    if timediffs.ndim > 1:
+        timediffs = timediffs[:, 0]
+    total = timediffs[-len(m["phase_wall"]):].mean()
+    inner = np.zeros((0, 2))
+    if "estep_iterations" in m:
+        inner = m["estep_iterations"]
+    if HUMAN:
+        print "%s [%d iterations, %.4fs each]:" % (f, len(m["phase_wall"]), total)
+        print "  %-10s %10s %10s %7s" % ("phase", "wall", "cpu", "share")
+        for phase, w, c in izip(phases, wall, cpu):
+            print "  %-10s %10.4f %10.4f %6.1f%%" % (phase, w, c, 100 * w / total)
+        if len(inner):
+            print "  E step: %.1f iterations per document, at most %d" % (inner[:, 0].mean(), inner[:, 1].max())
+        print "  peak memory: %.1f MB" % m["maxrss"].max()
+    else:
+        for phase, w, c in izip(phases, wall, cpu):
+            print "%s,%s,wall,%f" % (f, phase, w)
+            print "%s,%s,cpu,%f" % (f, phase, c)
+            print "%s,%s,share,%f" % (f, phase, w / total)
+        if len(inner):
+            print "%s,estep,inner_mean,%f" % (f, inner[:, 0].mean())
+            print "%s,estep,inner_max,%f" % (f, inner[:, 1].max())
+        print "%s,memory,maxrss_mb,%f" % (f, m["maxrss"].max())
 
 if not HUMAN:
-    print "model,type,iteration,k,time,eval,mu,eta,alpha"
+    print PHASES and "model,phase,stat,value" or "model,type,iteration,k,time,eval,mu,eta,alpha"
 
 for f in sys.argv[1:]:
+    if f == "--phases":
+        continue
     try:
         m = np.load(f)
     except:
         print "%s didn't work, skipping" % f
         continue
 
+    if PHASES:
+        print_phases(f, m)
+        continue
+
     if "loglikelihoods" in m:
         key = "loglikelihoods"
     else:
         key = "perwordbounds"
 
-    timediffs = np.cumsum(m['timediffs'])
+    timediffs = m['timediffs']
+    if timediffs.ndim > 1:
+        # OnlineLDA keeps a row per iteration, its seconds first
+        timediffs = timediffs[:, 0]
+    timediffs = np.cumsum(timediffs)
 
     nmn=os.path.dirname(f)
 
     if HUMAN:
         i = len(m[key])
-        print "%s [%d]: %f" % (f, i, m[key][-1])
+        # the latest iteration that estimated the bound
+        evaluated = m[key][~np.isnan(m[key])]
+        print "%s [%d]: %f" % (f, i, len(evaluated) and evaluated[-1] or np.nan)
     else:
         ll = m[key]
         k = m["k"]
         for i, (l, t) in enumerate(izip(ll, timediffs), 1):
+            if np.isnan(l):
+                # the bound wasn't estimated this iteration
+                continue
             print "%s,%s,%d,%d,%f,%f,%f,%f,%f" % (f, nmn, i, k, t, l, m["mu"], m["eta"], m["alpha"])
 
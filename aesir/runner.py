@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
 import sys
+import random
 import logging
 import argparse
 
+import numpy as np
+
 import aesir
 
 logging.basicConfig(
@@ -20,20 +23,35 @@ def main():
     parser.add_argument('--output', '-o', metavar='FILE', help='Save the model.')
     parser.add_argument('--topics', '-k', metavar='INT', default=100, type=int,
                         help='The number of topics to load.')
-    parser.add_argument('--burnin', '-b', metavar='INT', type=int, default=0,
-                        help='Burnin samples.')
+    parser.add_argument('--burnin', '-b', metavar='INT', type=int,
+                        help="Burnin samples, during which the hyperparameters aren't updated. (Default 0, or the continued model's)")
     parser.add_argument('--iterations', '-I', metavar='INT', default=1000, type=int,
                         help='Number of iterations.')
     parser.add_argument('--threads', '-t', metavar='INT', default=4, type=int,
                         help='The number of separate threads to run.')
+    parser.add_argument('--chunksize', metavar='INT', default=4096, type=int,
+                        help='Roughly how many token rows a thread works on at a time.')
     parser.add_argument('--continue', '-c', action='store_true', dest='kontinue',
                         help='Continue computing from an existing model.')
+    parser.add_argument('--float32', action='store_true',
+                        help='Keep the model parameters in single precision.')
+    parser.add_argument('--topk', metavar='INT', type=int, default=0,
+                        help="Only keep each document's this many best topics. (Default all)")
+    parser.add_argument('--sampler', choices=aesir.SAMPLERS, default='dense',
+                        help="Sample every token from all topics (dense), or from its document's top topics and an alias table over the rest (alias, needs --topk). Both draw from the same distribution.")
+    parser.add_argument('--seed', metavar='INT', type=int,
+                        help='Seed the random number generators, making the run reproducible.')
     args = parser.parse_args()
 
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
     logging.info("Loading data...")
     data = aesir.dataread(args.input)
     logging.info("Initializing model...")
-    model = aesir.freyr(data, K=args.topics, model_out=args.output)
+    dtype = args.float32 and np.float32 or np.float64
+    model = aesir.freyr(data, K=args.topics, model_out=args.output, dtype=dtype, topk=args.topk)
     logging.info("Finished initializing.")
     if args.kontinue:
         logging.info("Loading existing model...")
@@ -44,9 +62,10 @@ def main():
             logging.info("Can't continue. Starting from scratch.")
 
     logging.info("Starting MCMC...")
-    model.burnin_iterations = args.burnin
+    if args.burnin is not None:
+        model.burnin = args.burnin
     model.mcmc_iterations_max = args.iterations
-    model.mcmc(cores=args.threads)
+    model.mcmc(cores=args.threads, chunksize=args.chunksize, seed=args.seed, sampler=args.sampler)
     logging.info("Finished with MCMC!")
     logging.info("Saving model to '%s'..." % args.output)
     model.save_model(args.output)
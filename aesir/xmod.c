@@ -7,39 +7,154 @@
 #include <time.h>
 #include <float.h>
 #include <limits.h>
-#include <gsl/gsl_rng.h>
 #include <pthread.h>
 #include "fastapprox.h"
 
-#define QUEUE_INCREMENT 100
+// default number of token rows in a unit of work
+#define DEFAULT_CHUNK_SIZE 4096
+
+// how many times the alias sampler draws from a pair's table, throwing
+// back the document's top topics, before it scans the other topics instead
+#define ALIAS_TRIES 8
 
 // thread trackers
 pthread_t* thread_ids;
-// and mutex locks, one per topic (K)
-pthread_mutex_t* locks;
-// and the queue mutex
 
-pthread_mutex_t queue_lock;
-int queue;
+// the scheduler. the corpus is cut into chunks of whole documents with
+// about CHUNK_SIZE token rows each; chunk c is the documents
+// [chunk_starts[c], chunk_starts[c+1]). every thread owns a contiguous
+// range of chunks holding about the same number of tokens, so it sees the
+// same documents (and S and logpi rows) every iteration. a thread works
+// forwards through its own range and, once that's empty, steals from the
+// back of everyone else's. a range is packed into one word as
+// (back << 32) | front so it can be claimed with a single CAS.
+int CHUNK_SIZE;
+int* chunk_starts;
+volatile npy_uint64* chunk_ranges;
 
 // we'll need to pass thread parameters around
 typedef struct {
   int tid;
-  int Nj;
-  double* Z_array;
+  int J;
+  // whether the log tables are float32 rather than float64
+  int single;
+  npy_uint64 iteration;
+  // log likelihood, summed per chunk so the total doesn't depend on
+  // which thread did what.
+  double* Z_chunks;
   PyArrayObject *logphi;
   PyArrayObject *logpsi;
   PyArrayObject *logpi;
+  // with top-k documents, logpi is J x topk: the logs of each document's
+  // topk best topics, pi_indices. every other topic gets logfill[g].
+  PyArrayObject *pi_indices;
+  PyArrayObject *logfill;
+  int topk;
+  PyArrayObject *offsets;
   PyArrayObject *data;
-  PyArrayObject *Rphi;
-  PyArrayObject *Rpsi;
+  // every thread counts straight into the output Rphi and Rpsi with
+  // atomic adds, so nobody has to lock anything and the memory doesn't
+  // grow with the number of threads. S needs neither: a document only
+  // ever belongs to one thread.
+  int D;
+  int F;
+  int *Rphi;
+  int *Rpsi;
   PyArrayObject *S;
+  // with top-k documents, S is sparse instead: document g's topics and
+  // their counts are Stopics and Scounts[Soffsets[g]:Soffsets[g+1]],
+  // which has room for every topic the document could possibly hit.
+  PyArrayObject *Soffsets;
+  int *Stopics;
+  int *Scounts;
+  // for the alias sampler: row i of the corpus has the word and feature
+  // of pair row_pairs[i], or -1 if no other row does. pair p is word
+  // pairs[0, p] and feature pairs[1, p]; pair_mass[p] is the sum over k
+  // of phi[k, v] psi[k, f], and the K entries of alias_prob and
+  // alias_topic from p * K on are its alias table over the topics.
+  PyArrayObject *row_pairs;
+  PyArrayObject *pairs;
+  npy_intp num_pairs;
+  double *pair_mass;
+  double *alias_prob;
+  int *alias_topic;
 } thread_params;
 
 // need these for parallelization
 int NUM_CORES;
 int NUM_TOPICS;
 
+// random numbers come from counter-based streams, one per document per
+// iteration, derived from SEED. a document's samples are the same no
+// matter which thread draws them or how many threads there are.
+npy_uint64 SEED;
+
+// the splitmix64 finalizer; scrambles a 64 bit counter.
+static inline npy_uint64 mix64(npy_uint64 z) {
+  z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+  z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+  return z ^ (z >> 31);
+}
+
+static inline npy_uint64 doc_stream(npy_uint64 iteration, int g) {
+  return mix64(mix64(SEED + 0x9e3779b97f4a7c15ULL * iteration) + 0x9e3779b97f4a7c15ULL * (npy_uint64)g);
+}
+
+// draws a uniform double in [0, 1) from the stream, splitmix64 style.
+static inline double stream_uniform(npy_uint64 *state) {
+  *state += 0x9e3779b97f4a7c15ULL;
+  return (mix64(*state) >> 11) * (1.0 / 9007199254740992.0);
+}
+
+// claims the next chunk from the front of a range, or returns -1 if it's empty.
+static int claim_front(volatile npy_uint64 *range) {
+  npy_uint64 old, updated;
+  npy_uint32 front, back;
+  do {
+    old = *range;
+    front = (npy_uint32)(old & 0xffffffff);
+    back = (npy_uint32)(old >> 32);
+    if (front >= back)
+      return -1;
+    updated = ((npy_uint64)back << 32) | (front + 1);
+  } while (!__sync_bool_compare_and_swap(range, old, updated));
+  return front;
+}
+
+// claims the last chunk from a range, or returns -1 if it's empty.
+static int claim_back(volatile npy_uint64 *range) {
+  npy_uint64 old, updated;
+  npy_uint32 front, back;
+  do {
+    old = *range;
+    front = (npy_uint32)(old & 0xffffffff);
+    back = (npy_uint32)(old >> 32);
+    if (front >= back)
+      return -1;
+    updated = ((npy_uint64)(back - 1) << 32) | front;
+  } while (!__sync_bool_compare_and_swap(range, old, updated));
+  return back - 1;
+}
+
+// the next chunk for thread tid: its own first, then stolen ones.
+// *steps is how far around the other threads we've gone looking.
+static int next_chunk(int tid, int *steps) {
+  int chunk;
+  if (*steps == 0) {
+    chunk = claim_front(&chunk_ranges[tid]);
+    if (chunk >= 0)
+      return chunk;
+    *steps = 1;
+  }
+  while (*steps < NUM_CORES) {
+    chunk = claim_back(&chunk_ranges[(tid + *steps) % NUM_CORES]);
+    if (chunk >= 0)
+      return chunk;
+    (*steps)++;
+  }
+  return -1;
+}
+
 static PyObject* digamma(PyObject *self, PyObject *args) {
   float x;
   if (!PyArg_ParseTuple(args, "d", &x)) {
@@ -167,10 +282,20 @@ static inline double lnsumexp(double xarray[], int n) {
   return m + log(y);
 }
 
-inline void* index_pyarray(PyArrayObject *array, int i, int j) {
+inline void* index_pyarray(PyArrayObject *array, npy_intp i, npy_intp j) {
   return (void*)(array->data + i*array->strides[0] + j*array->strides[1]);
 }
 
+// reads a float32 or float64 log table entry
+static inline double log_at(PyArrayObject *array, npy_intp i, npy_intp j, int single) {
+  void *p = index_pyarray(array, i, j);
+  return single ? (double)*((float *)p) : *((double *)p);
+}
+
+inline npy_int64 doc_offset(PyArrayObject *offsets, int g) {
+  return *((npy_int64 *)(offsets->data + g*offsets->strides[0]));
+}
+
 inline static int find_index(double array[], int n, double value) {
   // binary search for a desired value.
   // opposite rules of the price is right: we want closest
@@ -206,162 +331,516 @@ inline static int find_index(double array[], int n, double value) {
 void* threaded_posterier_chunk(void* args) {
   thread_params* tp = (thread_params*)args;
 
-  /* seed the random number generator*/
-  gsl_rng *random_number_generator;
-  random_number_generator = gsl_rng_alloc (gsl_rng_mt19937);
-  gsl_rng_set(random_number_generator,time(NULL));
+  npy_uint64 stream;
 
   double f_array[NUM_TOPICS];
   double sz_array[NUM_TOPICS];
+  // the current document's row of logpi
+  double logpi_row[NUM_TOPICS];
 
-  double z, s, rand_x;
-  int i, v, f, g, c, k, ci, i_big, i_small;
+  double z, s, rand_x, fill;
+  int v, f, g, c, k, a, ci, chunk, steps;
+  npy_int64 i, i_end, slot;
 
   // have to manually initialize this array to 0's.
   unsigned long topic_hits[NUM_TOPICS];
   for (k=0; k<NUM_TOPICS; k++) topic_hits[k] = 0;
+  // the current document's counts, when S is sparse.
+  int doc_hits[NUM_TOPICS];
+  for (k=0; k<NUM_TOPICS; k++) doc_hits[k] = 0;
 
 
-  i = i_big = i_small = 0;
+  steps = 0;
   // okay, core algorithm
-  while (i_big < tp->Nj) {
-    // first get the index from the queue
-    pthread_mutex_lock(&queue_lock);
-    i_big = queue;
-    queue += QUEUE_INCREMENT;
-    pthread_mutex_unlock(&queue_lock);
-
-    if (i_big >= tp->Nj)
-        break;
-
-    for (i_small = 0; i_small < QUEUE_INCREMENT; i_small++) {
-      i = i_big + i_small;
-      if (i >= tp->Nj)
-        break;
-
-      // first fetch the data
-      // vocab item
-      v=*((int *)index_pyarray(tp->data, 1, i));
-      // feature item
-      f=*((int *)index_pyarray(tp->data, 2, i));
-      // docid
-      g=*((int *)index_pyarray(tp->data, 0, i));
-      // count
-      c=*((int *)index_pyarray(tp->data, 3, i));
-
-      // calculate the log likelihood
-      for (k=0; k<NUM_TOPICS; k++) {
-        f_array[k] =
-            *((double *)index_pyarray(tp->logphi, k, v)) +
-            *((double *)index_pyarray(tp->logpsi, k, f)) +
-            *((double *)index_pyarray(tp->logpi, g, k));
+  while ((chunk = next_chunk(tp->tid, &steps)) >= 0) {
+    for (g = chunk_starts[chunk]; g < chunk_starts[chunk + 1]; g++) {
+      if (tp->pi_indices) {
+        fill = *((double *)(tp->logfill->data + g*tp->logfill->strides[0]));
+        for (k=0; k<NUM_TOPICS; k++)
+          logpi_row[k] = fill;
+        for (a=0; a<tp->topk; a++)
+          logpi_row[*((int *)index_pyarray(tp->pi_indices, g, a))] = log_at(tp->logpi, g, a, tp->single);
+      } else {
+        for (k=0; k<NUM_TOPICS; k++)
+          logpi_row[k] = log_at(tp->logpi, g, k, tp->single);
+      }
+
+      /* seed the random number generator for this document */
+      stream = doc_stream(tp->iteration, g);
+
+      // the document's tokens are data[:, offsets[g]:offsets[g+1]]
+      i_end = doc_offset(tp->offsets, g + 1);
+      for (i = doc_offset(tp->offsets, g); i < i_end; i++) {
+        // first fetch the data
+        // vocab item
+        v=*((int *)index_pyarray(tp->data, 0, i));
+        // feature item
+        f=*((int *)index_pyarray(tp->data, 1, i));
+        // count
+        c=*((int *)index_pyarray(tp->data, 2, i));
+
+        // calculate the log likelihood
+        for (k=0; k<NUM_TOPICS; k++) {
+          f_array[k] =
+              log_at(tp->logphi, k, v, tp->single) +
+              log_at(tp->logpsi, k, f, tp->single) +
+              logpi_row[k];
+        }
+
+        z = lnsumexp(f_array, NUM_TOPICS);
+        s = 0;
+
+        // what we're building here is the conditional CDF, where
+        // sz_array[i] = p(x <= i)
+        // so sz_array (sum of z) is monotonically increasing, and
+        // at it's max should be close to 1.
+        // z is the log sum of the absolute probabilities, so
+        // we need to divide (sub in log space) total prob.
+        for (k = 0; k<NUM_TOPICS; k++) {
+          s += exp(f_array[k] - z);
+          sz_array[k] = s;
+        }
+
+
+        // alright, now let's count up all our topics.
+        for (ci=0; ci<c; ci++) {
+          tp->Z_chunks[chunk] += z;
+
+          rand_x = stream_uniform(&stream);
+          /* sample from exp(f_array[0]-z) */
+          k = find_index(sz_array, NUM_TOPICS, rand_x);
+          //for (k=0; k < NUM_TOPICS && rand_x >= sz_array[k]; k++);
+
+          topic_hits[k] += 1;
+        }
+
+        // finally we need to record these hits. other threads may be
+        // counting the same word or feature, so Rphi and Rpsi get atomic
+        // adds; this thread owns document g, so S doesn't need them.
+        for (k=0; k<NUM_TOPICS; k++) {
+          // don't bother if there aren't updates!
+          if (topic_hits[k] == 0)
+            continue;
+
+          __sync_fetch_and_add(&tp->Rphi[(npy_intp)k*tp->D + v], topic_hits[k]);
+          __sync_fetch_and_add(&tp->Rpsi[(npy_intp)k*tp->F + f], topic_hits[k]);
+          if (tp->S)
+            *((int *)index_pyarray(tp->S, g, k)) += topic_hits[k];
+          else
+            doc_hits[k] += topic_hits[k];
+
+          // make sure we reset the counter for next iteration.
+          topic_hits[k] = 0;
+        }
       }
 
-      z = lnsumexp(f_array, NUM_TOPICS);
-      s = 0;
-
-      // what we're building here is the conditional CDF, where
-      // sz_array[i] = p(x <= i)
-      // so sz_array (sum of z) is monotonically increasing, and
-      // at it's max should be close to 1.
-      // z is the log sum of the absolute probabilities, so
-      // we need to divide (sub in log space) total prob.
-      for (k = 0; k<NUM_TOPICS; k++) {
-        s += exp(f_array[k] - z);
-        sz_array[k] = s;
+      if (!tp->S) {
+        slot = doc_offset(tp->Soffsets, g);
+        for (k=0; k<NUM_TOPICS; k++) {
+          if (doc_hits[k] == 0)
+            continue;
+          tp->Stopics[slot] = k;
+          tp->Scounts[slot] = doc_hits[k];
+          slot++;
+          doc_hits[k] = 0;
+        }
       }
+    }
+  }
 
+  return NULL;
+}
 
-      // alright, now let's count up all our topics.
-      for (ci=0; ci<c; ci++) {
-        tp->Z_array[tp->tid] += z;
+// builds the alias tables (Vose's method) for thread tid's share of the
+// pairs, so a pair's topics can be drawn in constant time in proportion
+// to phi[k, v] psi[k, f].
+void* threaded_alias_tables(void* args) {
+  thread_params* tp = (thread_params*)args;
 
-        rand_x = gsl_rng_uniform(random_number_generator);
-        /* sample from exp(f_array[0]-z) */
-        k = find_index(sz_array, NUM_TOPICS, rand_x);
-        //for (k=0; k < NUM_TOPICS && rand_x >= sz_array[k]; k++);
+  double w[NUM_TOPICS];
+  int small[NUM_TOPICS];
+  int large[NUM_TOPICS];
+  double mass, *prob;
+  int *alias;
+  int v, f, k, s, l, ns, nl;
+  npy_intp pair, start, end;
+
+  start = tp->num_pairs * tp->tid / NUM_CORES;
+  end = tp->num_pairs * (tp->tid + 1) / NUM_CORES;
+  for (pair = start; pair < end; pair++) {
+    v = *((int *)index_pyarray(tp->pairs, 0, pair));
+    f = *((int *)index_pyarray(tp->pairs, 1, pair));
+    mass = 0;
+    for (k=0; k<NUM_TOPICS; k++) {
+      w[k] = exp(log_at(tp->logphi, k, v, tp->single) + log_at(tp->logpsi, k, f, tp->single));
+      mass += w[k];
+    }
+    tp->pair_mass[pair] = mass;
+
+    // scale the weights to average 1, then fill up every slot of a topic
+    // that's short of 1 with one that has more than 1 to spare.
+    prob = tp->alias_prob + pair * NUM_TOPICS;
+    alias = tp->alias_topic + pair * NUM_TOPICS;
+    ns = nl = 0;
+    for (k=0; k<NUM_TOPICS; k++) {
+      w[k] *= NUM_TOPICS / mass;
+      if (w[k] < 1)
+        small[ns++] = k;
+      else
+        large[nl++] = k;
+    }
+    while (ns > 0 && nl > 0) {
+      s = small[--ns];
+      l = large[--nl];
+      prob[s] = w[s];
+      alias[s] = l;
+      w[l] = (w[l] + w[s]) - 1;
+      if (w[l] < 1)
+        small[ns++] = l;
+      else
+        large[nl++] = l;
+    }
+    // whatever's left over is full, up to rounding.
+    while (nl > 0) {
+      l = large[--nl];
+      prob[l] = 1;
+      alias[l] = l;
+    }
+    while (ns > 0) {
+      s = small[--ns];
+      prob[s] = 1;
+      alias[s] = s;
+    }
+  }
 
-        topic_hits[k] += 1;
-      }
+  return NULL;
+}
+
+// draws a topic from a pair's alias table with a single uniform.
+static inline int alias_draw(thread_params *tp, npy_intp pair, double u) {
+  double x = u * NUM_TOPICS;
+  int j = (int)x;
+  if (j >= NUM_TOPICS)
+    j = NUM_TOPICS - 1;
+  if (x - j < tp->alias_prob[pair * NUM_TOPICS + j])
+    return j;
+  return tp->alias_topic[pair * NUM_TOPICS + j];
+}
+
+// the CDF of phi[k, v] psi[k, f] over the topics that aren't among the
+// document's top ones (those count as 0). returns the total.
+static double rest_cdf(thread_params *tp, int v, int f, char in_top[], double sz_array[]) {
+  double s = 0;
+  int k;
+  for (k=0; k<NUM_TOPICS; k++) {
+    if (!in_top[k])
+      s += exp(log_at(tp->logphi, k, v, tp->single) + log_at(tp->logpsi, k, f, tp->single));
+    sz_array[k] = s;
+  }
+  return s;
+}
+
+// the alias sampler's sweep over top-k documents. with fill the weight
+// every topic outside the document's top ones gets,
+//   p(k) ~ phi[k, v] psi[k, f] (fill + [k in top] (pi[k] - fill))
+// so a row's total is fill * (pair_mass - the top topics' phi psi) plus
+// the top topics' pi phi psi, which takes O(topk) instead of O(K). a draw
+// picks the top topics or the rest in proportion to their mass; the rest
+// come from the pair's alias table, throwing back the top topics. this is
+// the same distribution as the dense sweep's, up to rounding.
+void* threaded_alias_chunk(void* args) {
+  thread_params* tp = (thread_params*)args;
 
-      // finally we need to syncronize these hits with the other threads
-      for (k=0; k<NUM_TOPICS; k++) {
-        // don't bother syncing if there aren't updates!
-        if (topic_hits[k] == 0)
-          continue;
+  npy_uint64 stream;
 
-        // grab the mutex to make sure we don't have race conditions
-        pthread_mutex_lock(&locks[k]);
+  int topk = tp->topk;
+  int top_topics[topk];
+  double top_pi[topk];
+  // the cumulative pi phi psi of the top topics
+  double top_mass[topk];
+  char in_top[NUM_TOPICS];
+  double sz_array[NUM_TOPICS];
 
-        *((int *)index_pyarray(tp->Rphi, k, v)) += topic_hits[k];
-        *((int *)index_pyarray(tp->Rpsi, k, f)) += topic_hits[k];
-        *((int *)index_pyarray(tp->S, g, k)) += topic_hits[k];
+  double z, u, t, fill, top, rest, phipsi;
+  int v, f, g, c, k, a, ci, chunk, steps, tries, have_cdf, ntouched;
+  npy_int64 i, i_end, slot;
+  npy_intp pair;
 
-        // make sure we reset the counter for next iteration.
-        topic_hits[k] = 0;
+  // the current document's counts, and the topics it has hit so far
+  int doc_hits[NUM_TOPICS];
+  int touched[NUM_TOPICS];
+  for (k=0; k<NUM_TOPICS; k++) {
+    doc_hits[k] = 0;
+    in_top[k] = 0;
+  }
 
-        // and unlock
-        pthread_mutex_unlock(&locks[k]);
+  steps = 0;
+  while ((chunk = next_chunk(tp->tid, &steps)) >= 0) {
+    for (g = chunk_starts[chunk]; g < chunk_starts[chunk + 1]; g++) {
+      fill = exp(*((double *)(tp->logfill->data + g*tp->logfill->strides[0])));
+      for (a=0; a<topk; a++) {
+        top_topics[a] = *((int *)index_pyarray(tp->pi_indices, g, a));
+        top_pi[a] = exp(log_at(tp->logpi, g, a, tp->single));
+        in_top[top_topics[a]] = 1;
+      }
+      ntouched = 0;
+
+      /* seed the random number generator for this document */
+      stream = doc_stream(tp->iteration, g);
+
+      i_end = doc_offset(tp->offsets, g + 1);
+      for (i = doc_offset(tp->offsets, g); i < i_end; i++) {
+        v=*((int *)index_pyarray(tp->data, 0, i));
+        f=*((int *)index_pyarray(tp->data, 1, i));
+        c=*((int *)index_pyarray(tp->data, 2, i));
+        pair=*((int *)(tp->row_pairs->data + i*tp->row_pairs->strides[0]));
+
+        top = 0;
+        phipsi = 0;
+        for (a=0; a<topk; a++) {
+          t = exp(log_at(tp->logphi, top_topics[a], v, tp->single) +
+                  log_at(tp->logpsi, top_topics[a], f, tp->single));
+          phipsi += t;
+          top += top_pi[a] * t;
+          top_mass[a] = top;
+        }
+        if (pair >= 0) {
+          rest = topk < NUM_TOPICS ? tp->pair_mass[pair] - phipsi : 0;
+          if (rest < 0)
+            rest = 0;
+          have_cdf = 0;
+        } else {
+          // no other row has this word and feature, so a table wouldn't
+          // pay for itself: just add up the other topics.
+          rest = rest_cdf(tp, v, f, in_top, sz_array);
+          have_cdf = 1;
+        }
+        z = log(top + fill * rest);
+
+        for (ci=0; ci<c; ci++) {
+          tp->Z_chunks[chunk] += z;
+
+          u = stream_uniform(&stream) * (top + fill * rest);
+          if (u < top || rest <= 0) {
+            for (a=0; a<topk-1 && u >= top_mass[a]; a++);
+            k = top_topics[a];
+          } else {
+            k = -1;
+            if (!have_cdf) {
+              for (tries=0; tries<ALIAS_TRIES && k < 0; tries++) {
+                k = alias_draw(tp, pair, stream_uniform(&stream));
+                if (in_top[k])
+                  k = -1;
+              }
+            }
+            // the top topics have most of this pair's mass, so draw from
+            // the others directly.
+            if (k < 0) {
+              if (!have_cdf) {
+                rest_cdf(tp, v, f, in_top, sz_array);
+                have_cdf = 1;
+              }
+              k = find_index(sz_array, NUM_TOPICS, stream_uniform(&stream) * sz_array[NUM_TOPICS - 1]);
+            }
+          }
+
+          __sync_fetch_and_add(&tp->Rphi[(npy_intp)k*tp->D + v], 1);
+          __sync_fetch_and_add(&tp->Rpsi[(npy_intp)k*tp->F + f], 1);
+          if (doc_hits[k]++ == 0)
+            touched[ntouched++] = k;
+        }
       }
+
+      slot = doc_offset(tp->Soffsets, g);
+      for (a=0; a<ntouched; a++) {
+        k = touched[a];
+        tp->Stopics[slot] = k;
+        tp->Scounts[slot] = doc_hits[k];
+        slot++;
+        doc_hits[k] = 0;
+      }
+      for (a=0; a<topk; a++)
+        in_top[top_topics[a]] = 0;
     }
   }
 
-  // clean up
-  gsl_rng_free(random_number_generator);
+  return NULL;
 }
 
 static PyObject *xfactorialposterior(PyObject *self, PyObject *args) {
-  PyArrayObject *logphi,*logpsi,*logpi,*data,*Rphi,*Rpsi,*S;
-  int Nj,F,D,J,i,p,err;
-
-  if (!PyArg_ParseTuple(args, "O!O!O!O!iiii",
+  PyArrayObject *logphi,*logpsi,*logpi,*offsets,*data,*Rphi,*Rpsi,*S;
+  PyArrayObject *Stopics = NULL, *Scounts = NULL;
+  PyObject *pi_indices = Py_None, *logfill = Py_None, *Soffsets = Py_None;
+  PyObject *row_pairs = Py_None, *pairs = Py_None;
+  int F,D,J,i,p,err;
+  npy_uint64 iteration;
+
+  // data is the CSR corpus: offsets is the int64 array of document
+  // boundaries (length J+1), data holds the word, feature and count rows.
+  // iteration picks the random streams. for top-k documents, pi_indices
+  // (int32, J x topk) and logfill (float64, J) complete logpi, and the
+  // int64 Soffsets lay out the sparse S, which comes back as (Stopics, Scounts).
+  // giving them int32 row_pairs (one per row of data) and the 2 x P int32
+  // pairs as well picks the alias sampler.
+  if (!PyArg_ParseTuple(args, "O!O!O!O!O!iiiK|OOOOO",
     &PyArray_Type, &logphi,
     &PyArray_Type, &logpsi,
     &PyArray_Type, &logpi,
+    &PyArray_Type, &offsets,
     &PyArray_Type, &data,
-    &Nj,
     &D,
     &F,
-    &J)) {
+    &J,
+    &iteration,
+    &pi_indices,
+    &logfill,
+    &Soffsets,
+    &row_pairs,
+    &pairs)) {
       return NULL;
   }
+  int topk = pi_indices != Py_None;
+  if (topk && (!PyArray_Check(pi_indices) || !PyArray_Check(logfill) || !PyArray_Check(Soffsets) ||
+               PyArray_TYPE((PyArrayObject *)pi_indices) != NPY_INT ||
+               PyArray_TYPE((PyArrayObject *)logfill) != NPY_DOUBLE ||
+               PyArray_TYPE((PyArrayObject *)Soffsets) != NPY_INT64 ||
+               PyArray_DIM((PyArrayObject *)pi_indices, 1) != PyArray_DIM(logpi, 1))) {
+    PyErr_SetString(PyExc_TypeError, "top-k documents need int32 pi_indices shaped like logpi, float64 logfill and int64 Soffsets.");
+    return NULL;
+  }
+  int alias = row_pairs != Py_None;
+  if (alias && (!topk || !PyArray_Check(row_pairs) || !PyArray_Check(pairs) ||
+                PyArray_TYPE((PyArrayObject *)row_pairs) != NPY_INT ||
+                PyArray_TYPE((PyArrayObject *)pairs) != NPY_INT ||
+                PyArray_NDIM((PyArrayObject *)row_pairs) != 1 || PyArray_NDIM((PyArrayObject *)pairs) != 2 ||
+                PyArray_DIM((PyArrayObject *)row_pairs, 0) != PyArray_DIM(data, 1) ||
+                PyArray_DIM((PyArrayObject *)pairs, 0) != 2)) {
+    PyErr_SetString(PyExc_TypeError, "the alias sampler needs top-k documents, int32 row_pairs with one entry per row of data and 2 x P int32 pairs.");
+    return NULL;
+  }
 
-  int dims_Rphi[2] = {NUM_TOPICS, D};
-  int dims_Rpsi[2] = {NUM_TOPICS, F};
-  int dims_S[2] = {J, NUM_TOPICS};
+  // the log tables can be float32 or float64, but they have to agree.
+  int single = PyArray_TYPE(logphi) == NPY_FLOAT;
+  if ((!single && PyArray_TYPE(logphi) != NPY_DOUBLE) ||
+      PyArray_TYPE(logpsi) != PyArray_TYPE(logphi) ||
+      PyArray_TYPE(logpi) != PyArray_TYPE(logphi)) {
+    PyErr_SetString(PyExc_TypeError, "logphi, logpsi and logpi must all be float32 or all be float64.");
+    return NULL;
+  }
+
+  npy_intp dims_Rphi[2] = {NUM_TOPICS, D};
+  npy_intp dims_Rpsi[2] = {NUM_TOPICS, F};
+  npy_intp dims_S[2] = {J, NUM_TOPICS};
 
-  // we're going to need to sum all of these up in the end.
-  double Z_array[NUM_CORES];
   double Z = 0;
 
-  for (p=0; p<NUM_CORES; p++) Z_array[p] = 0;
+  // the alias tables take K * 12 bytes per pair, and are rebuilt every sweep.
+  npy_intp num_pairs = alias ? PyArray_DIM((PyArrayObject *)pairs, 1) : 0;
+  double *pair_mass = NULL, *alias_prob = NULL;
+  int *alias_topic = NULL;
+  if (num_pairs) {
+    pair_mass = (double *)malloc(num_pairs * sizeof(double));
+    alias_prob = (double *)malloc((size_t)num_pairs * NUM_TOPICS * sizeof(double));
+    alias_topic = (int *)malloc((size_t)num_pairs * NUM_TOPICS * sizeof(int));
+    if (!pair_mass || !alias_prob || !alias_topic) {
+      free(pair_mass);
+      free(alias_prob);
+      free(alias_topic);
+      return PyErr_NoMemory();
+    }
+  }
 
-  Rphi = (PyArrayObject *)PyArray_FromDims(2,dims_Rphi,NPY_INT);
-  Rpsi = (PyArrayObject *)PyArray_FromDims(2,dims_Rpsi,NPY_INT);
-  S = (PyArrayObject *)PyArray_FromDims(2,dims_S,NPY_INT);
+  Rphi = (PyArrayObject *)PyArray_ZEROS(2,dims_Rphi,NPY_INT,0);
+  Rpsi = (PyArrayObject *)PyArray_ZEROS(2,dims_Rpsi,NPY_INT,0);
+  if (topk) {
+    S = NULL;
+    npy_intp dims_Ssparse[1] = {(npy_intp)doc_offset((PyArrayObject *)Soffsets, J)};
+    Stopics = (PyArrayObject *)PyArray_ZEROS(1,dims_Ssparse,NPY_INT,0);
+    Scounts = (PyArrayObject *)PyArray_ZEROS(1,dims_Ssparse,NPY_INT,0);
+  } else {
+    S = (PyArrayObject *)PyArray_ZEROS(2,dims_S,NPY_INT,0);
+  }
+
+  // set up the scheduler: cut the corpus into chunks...
+  int num_chunks = 0;
+  npy_int64 chunk_end;
+  chunk_starts = (int *)malloc((J + 1) * sizeof(int));
+  chunk_starts[0] = 0;
+  i = 0;
+  while (i < J) {
+    chunk_end = doc_offset(offsets, i) + CHUNK_SIZE;
+    do {
+      i++;
+    } while (i < J && doc_offset(offsets, i) < chunk_end);
+    chunk_starts[++num_chunks] = i;
+  }
+  // we're going to need to sum all of these up in the end.
+  double* Z_chunks = (double *)calloc(num_chunks + 1, sizeof(double));
 
-  // reset the queue
-  pthread_mutex_lock(&queue_lock);
-  queue = 0;
-  pthread_mutex_unlock(&queue_lock);
+  // ... and give each thread an even share of the tokens.
+  npy_int64 num_tokens = doc_offset(offsets, J);
+  int first_chunk[NUM_CORES + 1];
+  int chunk = 0;
+  for (p=0; p<NUM_CORES; p++) {
+    while (chunk < num_chunks && doc_offset(offsets, chunk_starts[chunk]) < num_tokens * p / NUM_CORES)
+      chunk++;
+    first_chunk[p] = chunk;
+  }
+  first_chunk[NUM_CORES] = num_chunks;
+  chunk_ranges = (volatile npy_uint64 *)malloc(NUM_CORES * sizeof(npy_uint64));
+  for (p=0; p<NUM_CORES; p++) {
+    chunk_ranges[p] = ((npy_uint64)first_chunk[p + 1] << 32) | (npy_uint64)first_chunk[p];
+  }
 
   // k, we've initialized out output arrays
-  // let's start the threads.
+  // let's start the threads. from here until they're joined we only
+  // touch raw buffers, so let other Python threads (e.g. a background
+  // checkpoint) run meanwhile.
+  Py_BEGIN_ALLOW_THREADS
   thread_params* parameters = (thread_params*)malloc(NUM_CORES * sizeof(thread_params));
   for (p=0; p<NUM_CORES; p++) {
     thread_params* tp = &(parameters[p]);
     tp->tid = p;
-    tp->Nj = Nj;
-    tp->Z_array = Z_array;
+    tp->J = J;
+    tp->single = single;
+    tp->iteration = iteration;
+    tp->Z_chunks = Z_chunks;
     tp->logphi = logphi;
     tp->logpsi = logpsi;
     tp->logpi = logpi;
+    tp->pi_indices = topk ? (PyArrayObject *)pi_indices : NULL;
+    tp->logfill = topk ? (PyArrayObject *)logfill : NULL;
+    tp->topk = topk ? PyArray_DIM(logpi, 1) : 0;
+    tp->offsets = offsets;
     tp->data = data;
-    tp->Rphi = Rphi;
-    tp->Rpsi = Rpsi;
+    tp->D = D;
+    tp->F = F;
+    tp->Rphi = (int *)PyArray_DATA(Rphi);
+    tp->Rpsi = (int *)PyArray_DATA(Rpsi);
     tp->S = S;
+    tp->Soffsets = topk ? (PyArrayObject *)Soffsets : NULL;
+    tp->Stopics = topk ? (int *)PyArray_DATA(Stopics) : NULL;
+    tp->Scounts = topk ? (int *)PyArray_DATA(Scounts) : NULL;
+    tp->row_pairs = alias ? (PyArrayObject *)row_pairs : NULL;
+    tp->pairs = alias ? (PyArrayObject *)pairs : NULL;
+    tp->num_pairs = num_pairs;
+    tp->pair_mass = pair_mass;
+    tp->alias_prob = alias_prob;
+    tp->alias_topic = alias_topic;
+  }
 
-    err = pthread_create(&(thread_ids[p]), NULL, &threaded_posterier_chunk, (void*)tp);
+  // the alias sampler's tables have to be ready before anyone samples.
+  if (alias) {
+    for (p=0; p<NUM_CORES; p++) {
+      err = pthread_create(&(thread_ids[p]), NULL, &threaded_alias_tables, (void*)&(parameters[p]));
+    }
+    for (p=0; p<NUM_CORES; p++) {
+      pthread_join(thread_ids[p], NULL);
+    }
+  }
+
+  for (p=0; p<NUM_CORES; p++) {
+    err = pthread_create(&(thread_ids[p]), NULL, alias ? &threaded_alias_chunk : &threaded_posterier_chunk, (void*)&(parameters[p]));
   }
 
   // sync the threads.
@@ -369,32 +848,36 @@ static PyObject *xfactorialposterior(PyObject *self, PyObject *args) {
     pthread_join(thread_ids[p], NULL);
   }
   free(parameters);
+  free(pair_mass);
+  free(alias_prob);
+  free(alias_topic);
+  free(chunk_starts);
+  free((void *)chunk_ranges);
+  Py_END_ALLOW_THREADS
 
   // okay, all the threads are done. we need to accumulate total probability
-  for (p=0; p<NUM_CORES; p++) {
-    Z += Z_array[p];
+  for (i=0; i<num_chunks; i++) {
+    Z += Z_chunks[i];
   }
+  free(Z_chunks);
 
+  if (topk)
+    return Py_BuildValue("(NN(NN)d)", Rphi,Rpsi,Stopics,Scounts,Z);
   return Py_BuildValue("(NNNd)", Rphi,Rpsi,S,Z);
 
 }
 
 static PyObject *initialize(PyObject *self, PyObject *args) {
-  if (!PyArg_ParseTuple(args, "ii", &NUM_CORES, &NUM_TOPICS)) {
+  CHUNK_SIZE = DEFAULT_CHUNK_SIZE;
+  SEED = (npy_uint64)time(NULL);
+  if (!PyArg_ParseTuple(args, "ii|iK", &NUM_CORES, &NUM_TOPICS, &CHUNK_SIZE, &SEED)) {
     return NULL;
   }
-
-  // allocate the locks
-  locks = (pthread_mutex_t*) malloc(NUM_TOPICS * sizeof(pthread_mutex_t));
-  int k;
-  for (k=0; k<NUM_TOPICS; k++) {
-    if (pthread_mutex_init(&(locks[k]), NULL) != 0) {
-      printf("Lock init failed.\n");
-    }
+  if (CHUNK_SIZE < 1) {
+    PyErr_SetString(PyExc_ValueError, "chunksize must be positive.");
+    return NULL;
   }
 
-  pthread_mutex_init(&queue_lock, NULL);
-
   thread_ids = (pthread_t*) malloc(NUM_CORES * sizeof(pthread_t));
 
   return Py_BuildValue("z", NULL);
@@ -402,12 +885,6 @@ static PyObject *initialize(PyObject *self, PyObject *args) {
 
 static PyObject *finalize(PyObject *self, PyObject *args) {
   free(thread_ids);
-  int k;
-  for (k=0; k<NUM_TOPICS; k++) {
-    pthread_mutex_destroy(&(locks[k]));
-  }
-  pthread_mutex_destroy(&queue_lock);
-  free(locks);
   return Py_BuildValue("z", NULL);
 }
 